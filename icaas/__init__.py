@@ -24,6 +24,7 @@ from flask import Flask, jsonify
 from icaas.version import __version__
 from icaas.models import db
 from icaas.controllers.builds import builds
+from icaas.controllers.metrics import metrics
 from icaas.error import Error
 from icaas import settings
 
@@ -67,6 +68,7 @@ def create_app(**kwargs):
 
     # register our blueprints
     app.register_blueprint(builds)
+    app.register_blueprint(metrics)
 
     return app
 
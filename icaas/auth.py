@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Module for validating the user tokens against Astakos and mapping them to
+ICaaS users
+"""
+
+from datetime import datetime
+import calendar
+import hashlib
+import logging
+import re
+import threading
+import time
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+import astakosclient
+
+from icaas.models import User, db
+from icaas.cache import TTLCache
+from icaas import settings
+
+logger = logging.getLogger(__name__)
+
+# Validated (and rejected) tokens. The key is a hash of the token, so that
+# the cache never hosts user credentials.
+token_cache = TTLCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL)
+
+# Maps the Synnefo UUIDs of the users to their ICaaS ID and their last known
+# token
+user_cache = TTLCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+
+# Marks a token that was rejected by Astakos
+_REJECTED = object()
+
+# Astakos requests that are in progress, indexed by the token key
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+_TIMESTAMP = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?'
+                        r'(Z|([+-])(\d{2}):?(\d{2}))?$')
+
+
+def _token_key(token):
+    """Return the key used to cache a token"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _parse_expires(value):
+    """Convert an ISO 8601 timestamp returned by Astakos to a UNIX timestamp.
+    Returns None if the timestamp cannot be parsed.
+    """
+    match = _TIMESTAMP.match(value or '')
+    if match is None:
+        return None
+
+    stamp = datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+    seconds = calendar.timegm(stamp.timetuple())
+    if match.group(4):
+        offset = int(match.group(5)) * 3600 + int(match.group(6)) * 60
+        seconds -= offset if match.group(4) == '+' else -offset
+    return seconds
+
+
+class _Call(object):
+    """An Astakos token validation request that is in progress"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.uuid = None
+        self.error = None
+
+
+def _validate(token, key):
+    """Validate a token against Astakos and cache the result"""
+    astakos = astakosclient.AstakosClient(token, settings.AUTH_URL)
+    try:
+        access = astakos.authenticate()['access']
+    except astakosclient.errors.Unauthorized:
+        token_cache.set(key, _REJECTED,
+                        float(settings.TOKEN_CACHE_NEGATIVE_TTL))
+        raise
+
+    uuid = access['user']['id']
+
+    # Never cache a token for longer than Astakos considers it valid
+    ttl = token_cache.ttl
+    expires = _parse_expires(access.get('token', {}).get('expires'))
+    if expires is not None:
+        ttl = min(ttl, expires - time.time())
+    token_cache.set(key, uuid, ttl)
+
+    return uuid
+
+
+def authenticate(token):
+    """Validate a user token and return the UUID of its owner. Raises
+    astakosclient.errors.Unauthorized if the token is not valid.
+
+    Only one Astakos request is made at a time for the same token. Concurrent
+    callers wait for the outcome of the request that is already in progress.
+    When gevent has monkey patched the threading module, the waiting is done
+    cooperatively by the greenlets.
+    """
+    key = _token_key(token)
+    uuid = token_cache.get(key)
+    if uuid is _REJECTED:
+        logger.debug('X-Auth-Token found in the cache of rejected tokens')
+        raise astakosclient.errors.Unauthorized(message='UNAUTHORIZED',
+                                                details='invalid token')
+    elif uuid is not None:
+        logger.debug('X-Auth-Token found in the cache')
+        return uuid
+
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = _Call()
+
+    if not leader:
+        logger.debug('waiting for X-Auth-Token validation in progress')
+        if call.done.wait(float(settings.TOKEN_COALESCE_TIMEOUT)):
+            if call.error is not None:
+                raise call.error
+            return call.uuid
+        logger.warning('X-Auth-Token validation in progress timed out')
+        return _validate(token, key)
+
+    try:
+        call.uuid = _validate(token, key)
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        call.done.set()
+
+    return call.uuid
+
+
+def _detached_user(userid, uuid, token):
+    """Return a User object that is not attached to any database session"""
+    user = User(uuid)
+    user.id = userid
+    user.token = token
+    make_transient_to_detached(user)
+    return user
+
+
+def get_user(uuid, token):
+    """Return the user with the specified Synnefo UUID, creating it if needed.
+    The token of the user is updated only if it has changed. The returned User
+    object is detached from the database session.
+    """
+    cached = user_cache.get(uuid)
+    if cached is not None and cached[1] == token:
+        logger.debug('user %d found in the cache' % cached[0])
+        return _detached_user(cached[0], uuid, token)
+
+    user = User.query.filter_by(uuid=uuid).first()
+    if user is None:
+        user = User(uuid)
+        user.token = token
+        db.session.add(user)
+        try:
+            db.session.flush()
+            userid = user.id
+            db.session.commit()
+            logger.debug('added new user %d' % userid)
+        except IntegrityError:
+            # Another worker added the user in the meantime
+            db.session.rollback()
+            user = User.query.filter_by(uuid=uuid).one()
+
+    userid = user.id
+    if user.token != token:
+        user.token = token
+        db.session.commit()
+        logger.debug('update existing user %d' % userid)
+
+    user_cache.set(uuid, (userid, token))
+    return _detached_user(userid, uuid, token)
+
+# vim: ai ts=4 sts=4 et sw=4 ft=python
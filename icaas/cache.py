@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Module implementing a simple in-process cache"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache(object):
+    """A bounded, thread-safe LRU cache whose entries expire after a while"""
+
+    def __init__(self, size, ttl):
+        """Initialize a TTLCache instance. The cache will host up to `size`
+        entries and each entry will be valid for `ttl` seconds unless
+        specified otherwise when setting it.
+        """
+        self.size = int(size)
+        self.ttl = float(ttl)
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value of a valid entry or default if there is none"""
+        now = time.time()
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires <= now:
+                self.misses += 1
+                return default
+
+            # Mark the entry as the most recently used one
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Add an entry to the cache, evicting the least recently used ones if
+        the cache is full
+        """
+        if self.size <= 0:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+
+        expires = time.time() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove an entry from the cache"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries from the cache and reset the counters"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return the cache counters"""
+        with self._lock:
+            return {'size': len(self._data),
+                    'max_size': self.size,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+# vim: ai ts=4 sts=4 et sw=4 ft=python
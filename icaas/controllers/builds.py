@@ -22,35 +22,40 @@ from flask import (
     jsonify,
     Response,
     Blueprint,
-    copy_current_request_context
+    stream_with_context
 )
+from flask import json as flask_json
 
 from functools import wraps
+import hashlib
 from datetime import datetime, timedelta
-from base64 import b64encode
-import ConfigParser
-import StringIO
 import logging
-import threading
+import socket
+import urllib
+import urlparse
 import json
+import time
 
-from kamaki.clients import cyclades, ClientError
+from sqlalchemy import and_, or_, func, bindparam
+from sqlalchemy.orm import load_only
 from kamaki.clients.utils import https
 
 import astakosclient
 
-from icaas.models import Build, User, db
+from icaas.models import Build, BuildEvent, BuildProgress, Job, User, db
 from icaas.error import Error
-from icaas.utils import destroy_agent
+from icaas.utils import (update_status_details, record_progress, add_event,
+                         insert_all, check_callback_host)
+from icaas.auth import authenticate, get_user
+from icaas.workers import create_pool, destroy_pool
+from icaas import jobs
+from icaas import notify
 from icaas import settings
 
 https.patch_with_certs(settings.KAMAKI_SSL_LOCATION)
 
 builds = Blueprint('builds', __name__)
 
-AGENT_CONFIG = "/etc/icaas/manifest.cfg"
-AGENT_INIT = "/.icaas"
-
 logger = logging.getLogger(__name__)
 
 
@@ -59,43 +64,83 @@ def _build_to_links(build):
     return [{"href": url, "rel": "self"}]
 
 
-def _update_status_details(build, params):
-    details = build.status_details
-    details = json.loads(details) if details else {}
-    curtask = params.get('details', None)
-    if curtask:
-        details['details'] = curtask
-    agent_progress = params.get("agent-progress", None)
-    if agent_progress:
-        try:
-            details['agent-progress'] = {
-                'current': int(agent_progress['current']),
-                'total': int(agent_progress['total'])}
-        except (ValueError, KeyError, TypeError) as e:
-            logger.warning("Failed to parse 'agent-progress' with error '%s'",
-                           str(e))
-            raise Error("Malformed status details", status=400)
-
-    build.status_details = json.dumps(details)
-
-
-def _build_to_dict(build):
-    d = {"id": build.id,
-         "name": build.name,
-         "src": build.src,
-         "description": build.description,
-         "public": build.public,
-         "status": build.status,
-         "status_details": build.status_details,
-         "image": json.loads(build.image),
-         "log": json.loads(build.log),
-         "created": build.created,
-         "updated": build.updated,
-         "links": _build_to_links(build)}
+def _progress(builds):
+    """Return the latest progress reported by the agents of the active builds
+    indexed by the build ID
+    """
+    # Only the agents of the builds being created report progress
+    ids = [b.id for b in builds if b.status == 'CREATING']
+    if not ids:
+        return {}
+
+    rows = BuildProgress.query.filter(BuildProgress.build.in_(ids),
+                                      BuildProgress.current != None)  # noqa
+    return dict((row.build, row) for row in rows)
+
+
+# The attributes of a build returned by the API
+FIELDS = ('id', 'name', 'src', 'description', 'public', 'status',
+          'status_details', 'image', 'log', 'created', 'updated', 'links')
+
+# The attributes of a build in the short listing
+SHORT_FIELDS = ('id', 'name', 'links')
+
+
+def _status_details(build, progress):
+    """Return the status details of a build"""
+    status_details = build.status_details
+    if progress is not None:
+        # The progress may not have been written to the build yet
+        details = json.loads(status_details) if status_details else {}
+        details['agent-progress'] = progress.to_dict()
+        status_details = json.dumps(details)
+    return status_details
+
+
+def _build_to_dict(build, progress=None, fields=FIELDS):
+    """Return the requested attributes of a build. The build may be a row
+    holding only the columns the attributes need.
+    """
+    convert = {"status_details": lambda b: _status_details(b, progress),
+               "image": lambda b: json.loads(b.image),
+               "log": lambda b: json.loads(b.log),
+               "links": _build_to_links}
+
+    d = {}
+    for field in fields:
+        if field in convert:
+            d[field] = convert[field](build)
+        else:
+            d[field] = getattr(build, field)
 
     return d
 
 
+def _check_fields(fields):
+    """Check the attributes of the builds requested by the user and return
+    them
+    """
+    fields = [f for f in fields.split(',') if f]
+    invalid = [f for f in fields if f not in FIELDS]
+    if not fields or invalid:
+        raise Error("Invalid value for parameter 'fields'. Valid values are: "
+                    "'%s'" % "', '".join(FIELDS), status=400)
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+    return fields
+
+
+def _columns(fields):
+    """Return the columns needed to return some attributes of the builds"""
+    # The ETag of the listings is derived from the update time
+    names = ['id', 'deleted', 'updated']
+    if 'status_details' in fields:
+        # The progress of the active builds is added to the details
+        names.append('status')
+    names.extend(f for f in fields if f != 'links' and f not in names)
+    return [getattr(Build, name) for name in names]
+
+
 def _create_manifest(build, token):
     """Create manifest to be send to the ICaaS Agent VM"""
 
@@ -140,6 +185,40 @@ def _create_manifest(build, token):
     return manifest
 
 
+def _check_pool(pool):
+    """Reject the request if a worker pool cannot accept any more tasks"""
+    if pool.full():
+        raise Error("Service is busy, please try again later", status=503)
+
+
+def _check_timeout(minutes, name):
+    """Check if a timeout in minutes provided by the user is valid"""
+    if minutes is None:
+        raise Error("Parameter: '%s' is missing" % name, status=400)
+    if type(minutes) != int or minutes <= 0 or \
+            minutes > settings.MAX_AGENT_TIMEOUT:
+        raise Error("Parameter: '%s' should be a number of minutes between 1 "
+                    "and %d" % (name, settings.MAX_AGENT_TIMEOUT), status=400)
+    return minutes
+
+
+def _check_callback(url):
+    """Check if a callback URL provided by the user is valid"""
+    if not isinstance(url, basestring) or len(url) > 1024 or \
+            urlparse.urlparse(url).scheme not in ('http', 'https') or \
+            not urlparse.urlparse(url).netloc:
+        raise Error("Parameter: 'callback' should be an http or https URL",
+                    status=400)
+    try:
+        check_callback_host(urlparse.urlparse(url).hostname)
+    except ValueError as e:
+        raise Error("Parameter: 'callback': %s" % e, status=400)
+    except socket.error:
+        # It may resolve by the time the build finishes. The host is checked
+        # again before the callback is sent.
+        pass
+
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -148,10 +227,9 @@ def login_required(f):
             logger.debug('X-Auth-Token missing')
             raise Error("Token is missing", status=401)
         token = request.headers["X-Auth-Token"]
-        astakos = astakosclient.AstakosClient(token, settings.AUTH_URL)
 
         try:
-            astakos = astakos.authenticate()
+            uuid = authenticate(token)
             logger.debug('X-Auth-Token is valid')
         except astakosclient.errors.Unauthorized:
             logger.debug('X-Auth-Token not valid')
@@ -161,20 +239,7 @@ def login_required(f):
             raise Error("Internal server error", status=500)
 
         logger.debug('checking if user is present in the database')
-        uuid = astakos['access']['user']['id']
-        user = User.query.filter_by(uuid=uuid).first()
-        if not user:
-            user = User(astakos['access']['user']['id'])
-            user.token = token
-            db.session.add(user)
-            db.session.commit()
-            logger.debug('added new user %d' % user.id)
-        elif user.token != token:
-            user.token = token
-            db.session.commit()
-            logger.debug('update existing user %d' % user.id)
-        else:
-            logger.debug('user %d found' % user.id)
+        user = get_user(uuid, token)
 
         return f(user, *args, **kwargs)
     return decorated_function
@@ -201,39 +266,27 @@ def agent_manifest(buildid, nonce):
         # This should never happen
         logger.error("Unknown user: %d for build %d", (build.user, build.id))
 
-    now = datetime.utcnow()
-    expires = build.created + timedelta(minutes=settings.MANIFEST_TIMEOUT)
-    if expires < now:
+    if build.get_manifest_deadline() < datetime.utcnow():
         logger.warning("Manifest retrieval expired!")
         build.nonce_invalid = True
         build.status = 'ERROR'
-        build.details = 'Agent start up expired'
-        db.session.commit()
-
-        @copy_current_request_context
-        def destroy_agent_wrapper():
-            """Thread that will kill the agent VM"""
-            build = Build.query.filter_by(id=buildid).first()
-            if build is None:
-                # Normally this cannot happen
-                logger.error('Build with id=%d not found!' % build.id)
-                return
-            destroy_agent(build)
-
+        update_status_details(build, {'details': 'Agent start up expired'})
+        job = None
         if not settings.DEBUG:
-            thread = threading.Thread(target=destroy_agent_wrapper,
-                                      name="DestroyAgentThread-%d" % build.id)
-            thread.daemon = False
-            thread.start()
+            job = jobs.enqueue(build, 'DESTROY')
         else:
             logger.warning('not deleting the agent VM on errors in debug mode')
+        db.session.commit()
+
+        if job is not None:
+            jobs.dispatch(job)
         raise Error("Manifest retrieval expired", status=403)
 
     if not build.is_active():
         raise Error("Build is not active", status=403)
 
     build.nonce_invalid = True
-    _update_status_details(build, {'details': "Agent booted normally"})
+    record_progress(build, {'details': "Agent booted normally"}, flush=True)
     db.session.commit()
 
     return jsonify({"manifest": _create_manifest(build, user.token)})
@@ -248,8 +301,9 @@ def agent_update(buildid):
         raise Error("Missing ICaaS token", status=401)
     token = request.headers["X-Icaas-Token"]
 
-    build = Build.query.filter_by(id=buildid, token=token,
-                                  deleted=False).first()  # noqa
+    # Most of the updates only report progress. Don't load the big columns.
+    build = Build.query.options(load_only('id', 'user', 'status')) \
+        .filter_by(id=buildid, token=token, deleted=False).first()  # noqa
     if build is None:
         raise Error("Build not found", status=404)
 
@@ -270,29 +324,25 @@ def agent_update(buildid):
         if status == 'CANCELED':
             raise Error('Agent cannot cancel a build', status=403)
 
-        build.status = status
+        if status == 'QUEUED':
+            raise Error('Agent cannot queue a build', status=403)
 
-        _update_status_details(build, params)
+        # Should we delete the agent VM?
+        destroy = status == "COMPLETED" or \
+            (status == "ERROR" and not settings.DEBUG)
+        if destroy:
+            _check_pool(destroy_pool)
+
+        changed = status != build.status or bool(params.get('details'))
+        if status != build.status:
+            build.status = status
+
+        record_progress(build, params, flush=changed)
+        job = jobs.enqueue(build, 'DESTROY') if destroy else None
         db.session.commit()
 
-        # Should we delete the agent VM?
-        if status == "COMPLETED" or (status == "ERROR" and not settings.DEBUG):
-
-            @copy_current_request_context
-            def destroy_agent_wrapper():
-                """Thread that will kill the agent VM"""
-                # Check create_agent() to see why we are doing this
-                build = Build.query.filter_by(id=buildid).first()
-                if build is None:
-                    # Normally this cannot happen
-                    logger.error('Build with id=%d not found!' % build.id)
-                    return
-                destroy_agent(build)
-
-            thread = threading.Thread(target=destroy_agent_wrapper,
-                                      name="DestroyAgentThread-%d" % build.id)
-            thread.daemon = False
-            thread.start()
+        if job is not None:
+            jobs.dispatch(job)
         elif status == 'ERROR':
             logger.warning('not deleting the agent VM on errors in debug mode')
 
@@ -324,47 +374,240 @@ def update(user, buildid):
     if action is None:
         raise Error("Parameter: 'action' is missing", status=400)
 
-    if action.lower() != 'cancel':
+    action = action.lower()
+    if action not in ('cancel', 'extend'):
         raise Error('Invalid action', status=400)
 
+    if build.status == 'QUEUED':
+        # The build may be starting right now
+        jobs.lock_queue()
+        db.session.refresh(build)
+
     if not build.is_active():
         raise Error("Build is not active", status=403)
 
+    if action == 'extend':
+        minutes = _check_timeout(params.get('minutes', None), 'minutes')
+        total = build.get_agent_deadline() - build.created
+        if total.total_seconds() / 60 + minutes > settings.MAX_AGENT_TIMEOUT:
+            raise Error("The build cannot run for more than %d minutes" %
+                        settings.MAX_AGENT_TIMEOUT, status=400)
+        build.extend_deadline(minutes)
+        db.session.commit()
+        return Response(status=204)
+
+    # A queued build has no agent to destroy
+    queued = build.status == 'QUEUED'
+    if not queued:
+        _check_pool(destroy_pool)
+
     build.status = 'CANCELED'
-    _update_status_details(build, {'details': "Canceled by the user"})
+    update_status_details(build, {'details': "Canceled by the user"})
+    if queued:
+        jobs.dequeue([build.id])
+        job = None
+    else:
+        job = jobs.enqueue(build, 'DESTROY')
     db.session.commit()
 
-    @copy_current_request_context
-    def destroy_agent_wrapper():
-        """Thread that will kill the agent VM"""
-        # Check create_agent() to see why we are doing this
-        build = Build.query.filter_by(id=buildid).first()
-        if build is None:
-            # Normally this cannot happen
-            logger.error('Build with id=%d not found!' % build.id)
-            return
-        destroy_agent(build)
-
-    thread = threading.Thread(target=destroy_agent_wrapper,
-                              name="DestroyAgentThread-%d" % build.id)
-    thread.daemon = False
-    thread.start()
+    if job is not None:
+        jobs.dispatch(job)
 
     return Response(status=204)
 
 
+def _not_modified(etag):
+    """Tell the client that the version of the response it has is current"""
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def _check_wait(wait):
+    """Check if the time to wait provided by the user is valid"""
+    try:
+        wait = float(wait)
+    except ValueError:
+        wait = -1
+    # This also rejects nan and inf
+    if not 0 <= wait <= float(settings.MAX_WAIT):
+        raise Error("Invalid value for parameter 'wait'. It should be a "
+                    "number of seconds between 0 and %s" % settings.MAX_WAIT,
+                    status=400)
+    return wait
+
+
+def _wait_for_change(get_build, buildid, wait, since):
+    """Wait until an active build is updated after `since` or the time to
+    wait runs out and return the build. If `since` is not specified, wait for
+    the next update. The database connection is released while waiting.
+    """
+    deadline = time.time() + wait
+    changed = notify.subscribe(('build', buildid))
+    try:
+        build = get_build()
+        if since is None:
+            since = build.updated
+        else:
+            since = _parse_timestamp(since, 'since')
+            if not since.microsecond:
+                # The timestamps returned by the API are rounded down to
+                # seconds
+                since = since.replace(microsecond=999999)
+
+        while build.is_active() and build.updated <= since:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            db.session.close()
+            # Changes made by other processes are not announced
+            changed.wait(min(remaining, float(settings.WAIT_RECHECK)))
+            changed.clear()
+            build = get_build()
+    finally:
+        notify.unsubscribe(('build', buildid), changed)
+
+    return build
+
+
 @builds.route('/icaas/builds/<int:buildid>', methods=['GET'])
 @login_required
 def view(user, buildid):
-    """View a specific build entry"""
+    """View a specific build entry. If `wait` is specified, wait up to that
+    many seconds for an active build to change after `since`.
+    """
     logger.info("view build %d by user %s" % (buildid, user.id))
 
-    build = Build.query.filter_by(id=buildid, user=user.id,
-                                  deleted=False).first()  # noqa
+    def get_build():
+        build = Build.query.filter_by(id=buildid, user=user.id,
+                                      deleted=False).first()  # noqa
+        if not build:
+            raise Error("Build not found", status=404)
+        return build
+
+    wait = request.args.get('wait')
+    if wait is None:
+        build = get_build()
+    else:
+        build = _wait_for_change(get_build, buildid, _check_wait(wait),
+                                 request.args.get('since'))
+
+    progress = _progress([build]).get(build.id)
+    etag = "%d-%s-%s" % (build.id, build.updated.isoformat(),
+                         progress.current if progress else '')
+    if request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+
+    response = jsonify({"build": _build_to_dict(build, progress)})
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def _event_to_dict(event):
+    d = {"id": event.id,
+         "created": event.created,
+         "status": event.status,
+         "details": event.details}
+    if event.current is not None:
+        d["agent-progress"] = {"current": event.current,
+                               "total": event.total}
+    return d
+
+
+@builds.route('/icaas/builds/<int:buildid>/events', methods=['GET'])
+@login_required
+def events(user, buildid):
+    """List the events in the timeline of a build"""
+    logger.info("events of build %d by user %s" % (buildid, user.id))
+
+    build = db.session.query(Build.id).filter_by(
+        id=buildid, user=user.id, deleted=False).first()  # noqa
     if not build:
         raise Error("Build not found", status=404)
 
-    return jsonify({"build": _build_to_dict(build)})
+    since = request.args.get('since', '0')
+    try:
+        since = int(since)
+    except ValueError:
+        raise Error("Invalid value for parameter 'since'", status=400)
+
+    evts = BuildEvent.query.filter(BuildEvent.build == buildid,
+                                   BuildEvent.id > since) \
+        .order_by(BuildEvent.id).limit(int(settings.EVENTS_PAGE_SIZE)).all()
+
+    # The events show up as their transactions commit, not necessarily in
+    # the order of their IDs. Hold the cursor back at the recent ones, so
+    # that the next request scans them again.
+    settled = datetime.utcnow() - \
+        timedelta(seconds=int(settings.WATERMARK_LAG))
+    cursor = since
+    for e in evts:
+        if e.created >= settled:
+            break
+        cursor = e.id
+    if cursor == since and len(evts) == int(settings.EVENTS_PAGE_SIZE):
+        cursor = evts[-1].id
+
+    return jsonify({"events": [_event_to_dict(e) for e in evts],
+                    "next": cursor})
+
+
+def _stream_events(userid, last):
+    """Generate the build events of a user in the Server-Sent Events format.
+    No database connection is held while waiting for new events.
+    """
+    changed = notify.subscribe(('user', userid))
+    try:
+        yield "retry: %d\n\n" % (int(settings.WAIT_RECHECK) * 1000)
+        cursor = notify.EventCursor(last)
+        while True:
+            changed.clear()
+            evts = cursor.fetch(BuildEvent.query.filter(
+                BuildEvent.user == userid))
+            db.session.close()
+
+            for e in evts:
+                data = _event_to_dict(e)
+                data["build"] = e.build
+                yield "id: %d\nevent: build\ndata: %s\n\n" % \
+                    (e.id, flask_json.dumps(data))
+            if len(evts) == int(settings.EVENTS_PAGE_SIZE):
+                continue
+
+            # The events of other processes are announced by the poller, so
+            # the database is only checked again when something changed
+            while not changed.wait(float(settings.STREAM_KEEPALIVE)):
+                yield ": keep-alive\n\n"
+    finally:
+        notify.unsubscribe(('user', userid), changed)
+
+
+@builds.route('/icaas/builds/stream', methods=['GET'])
+@login_required
+def stream(user):
+    """Stream the events of the builds of a user. The stream resumes after
+    the event with ID `Last-Event-ID` or starts with the next event.
+    """
+    logger.info("stream build events to user %s" % user.id)
+
+    last = request.headers.get('Last-Event-ID')
+    if last is None:
+        last = db.session.query(func.max(BuildEvent.id)) \
+            .filter(BuildEvent.user == user.id).scalar() or 0
+    else:
+        try:
+            last = int(last)
+        except ValueError:
+            raise Error("Invalid value for header 'Last-Event-ID'",
+                        status=400)
+    db.session.close()
+
+    response = Response(stream_with_context(_stream_events(user.id, last)),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Don't let nginx buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @builds.route('/icaas/builds/<int:buildid>', methods=['DELETE'])
@@ -377,176 +620,473 @@ def delete(user, buildid):
                                   deleted=False).first()  # noqa
     if not build:
         raise Error("Build not found", status=404)
+
+    if build.status == 'QUEUED':
+        # The build may be starting right now
+        jobs.lock_queue()
+        db.session.refresh(build)
+
+    agent_alive = build.agent_alive
+    if agent_alive:
+        _check_pool(destroy_pool)
+
     build.deleted = True
+    add_event(build, "Build deleted")
+    if build.status == 'QUEUED':
+        jobs.dequeue([build.id])
+    job = jobs.enqueue(build, 'DESTROY') if agent_alive else None
     db.session.commit()
 
-    buildid = build.id
-
-    @copy_current_request_context
-    def destroy_agent_wrapper():
-        """Thread that will kill the agent VM"""
-        # Check create_agent() to see why we are doing this
-        build = Build.query.filter_by(id=buildid).first()
-        if build is None:
-            # Normally this cannot happen
-            logger.error('Build with id=%d not found!' % build.id)
-            return
-        destroy_agent(build)
-
-    if build.agent_alive:
-        thread = threading.Thread(target=destroy_agent_wrapper,
-                                  name="DestroyAgentThread-%d" % build.id)
-        thread.daemon = False
-        thread.start()
+    if job is not None:
+        jobs.dispatch(job)
 
     return Response(status=204)
 
 
+def _bulk_targets(user, params, active):
+    """Return the IDs of the builds of a user a bulk action applies to and
+    the builds that were found. The builds are selected by the `ids` or the
+    `filter` parameter. Only the active builds match a filter if `active` is
+    True.
+    """
+    ids = params.get('ids', None)
+    criteria = params.get('filter', None)
+    if (ids is None) == (criteria is None):
+        raise Error("Exactly one of the parameters: 'ids' and 'filter' is "
+                    "required", status=400)
+
+    query = db.session.query(Build.id, Build.user, Build.status,
+                             Build.agent_alive, Build.callback,
+                             Build.status_details) \
+        .filter(Build.user == user.id, Build.deleted == False)  # noqa
+    limit = int(settings.BULK_MAX_BUILDS)
+
+    if ids is not None:
+        if type(ids) != list or not ids or len(ids) > limit or \
+                any(type(i) != int for i in ids):
+            raise Error("Parameter: 'ids' should be a list of up to %d build "
+                        "IDs" % limit, status=400)
+        seen = set()
+        ids = [i for i in ids if not (i in seen or seen.add(i))]
+        return ids, query.filter(Build.id.in_(ids)).with_for_update().all()
+
+    if type(criteria) != dict or not criteria or \
+            set(criteria) - set(('status', 'name_prefix')):
+        raise Error("Parameter: 'filter' should hold a 'status' and/or a "
+                    "'name_prefix'", status=400)
+    status = criteria.get('status', None)
+    if status is not None:
+        if status not in Build.get_status_types():
+            raise Error("Invalid value for filter 'status'", status=400)
+        query = query.filter(Build.status == status)
+    prefix = criteria.get('name_prefix', None)
+    if prefix is not None:
+        if not isinstance(prefix, basestring) or not prefix:
+            raise Error("Invalid value for filter 'name_prefix'", status=400)
+        query = query.filter(Build.name.startswith(prefix, autoescape=True))
+    if active:
+        query = query.filter(Build.status.in_(jobs.ACTIVE_STATUSES))
+
+    # Up to BULK_MAX_BUILDS builds are processed at once. The rest match the
+    # same filter next time.
+    found = query.order_by(Build.id).limit(limit).with_for_update().all()
+    return [b.id for b in found], found
+
+
+@builds.route('/icaas/builds', methods=['PUT'])
+@login_required
+def bulk_update(user):
+    """Cancel or delete many builds at once. The builds are updated with a
+    single statement and the destruction of their agents is left to the
+    bounded pool of the destroy jobs. The outcome of each build is returned.
+    """
+    params = request.get_json()
+    if type(params) != dict or not params.get('action', None):
+        raise Error("Parameter: 'action' is missing", status=400)
+    action = params['action']
+    if not isinstance(action, basestring) or \
+            action.lower() not in ('cancel', 'delete'):
+        raise Error('Invalid action', status=400)
+    action = action.lower()
+    logger.info("bulk %s by user %s" % (action, user.id))
+
+    # Some of the builds may be starting right now
+    jobs.lock_queue()
+    requested, found = _bulk_targets(user, params, action == 'cancel')
+    results = dict((i, {"id": i, "status": 404,
+                        "message": "Build not found"}) for i in requested)
+
+    if action == 'cancel':
+        for b in found:
+            if b.status not in jobs.ACTIVE_STATUSES:
+                results[b.id] = {"id": b.id, "status": 403,
+                                 "message": "Build is not active"}
+        targets = [b for b in found if b.status in jobs.ACTIVE_STATUSES]
+        # Like a single cancel, the agent may still be under creation. The
+        # queued builds have no agent.
+        destroy = [b for b in targets if b.status == 'CREATING']
+    else:
+        targets = found
+        destroy = [b for b in targets if b.agent_alive]
+    waiting = [b.id for b in targets if b.status == 'QUEUED']
+
+    if destroy:
+        _check_pool(destroy_pool)
+
+    now = datetime.utcnow()
+    ids = [b.id for b in targets]
+    queued = []
+    if targets:
+        table = Build.__table__
+        if action == 'cancel':
+            details = "Canceled by the user"
+            # Each build keeps the rest of its status details, including the
+            # progress that has not been written to it yet
+            progress = _progress(targets)
+            rows = []
+            for b in targets:
+                status_details = json.loads(
+                    _status_details(b, progress.get(b.id)) or '{}')
+                status_details['details'] = details
+                rows.append({'_id': b.id,
+                             '_details': json.dumps(status_details)})
+            db.session.execute(
+                table.update().where(table.c.id == bindparam('_id'))
+                .values(status='CANCELED', updated=now,
+                        status_details=bindparam('_details')), rows)
+            events = [BuildEvent(b.id, b.user, 'CANCELED', details)
+                      for b in targets]
+            # The session does not see the builds finishing
+            callbacks = [Job(b.id, 'NOTIFY', {'url': b.callback,
+                                              'status': 'CANCELED'})
+                         for b in targets if b.callback]
+        else:
+            db.session.execute(table.update().where(table.c.id.in_(ids))
+                               .values(deleted=True, updated=now))
+            events = [BuildEvent(b.id, b.user, b.status, "Build deleted")
+                      for b in targets]
+            callbacks = []
+
+        insert_all(events)
+        insert_all([Job(b.id, 'DESTROY') for b in destroy] + callbacks)
+        jobs.dequeue(waiting)
+        queued = db.session.query(Job.id, Job.action).filter(
+            Job.build.in_(ids), Job.state == 'PENDING',
+            Job.action.in_(('DESTROY', 'NOTIFY'))).all()
+    db.session.commit()
+
+    # The changes were not made through the session
+    for buildid in ids:
+        notify.notify(('build', buildid))
+        results[buildid] = {"id": buildid, "status": 204}
+    notify.notify(('user', user.id))
+    for kind in ('DESTROY', 'NOTIFY'):
+        jobs.dispatch_all([j for j, a in queued if a == kind], kind)
+    if any(b.status == 'CREATING' for b in targets):
+        jobs.slots_freed()
+
+    return jsonify(builds=[results[i] for i in requested])
+
+
+def _parse_build(params):
+    """Check the parameters of a new build provided by the user and return
+    them
+    """
+    if not params:
+        fields = ['name', 'src', 'image', 'log']
+        raise Error('Required fields: "%s" are missing from namespace "build"'
+                    % '", "'.join(fields), status=400)
+    if type(params) != dict:
+        raise Error('"build" parameter is not a dictionary', status=400)
+
+    missing = "Parameter: '%s' is missing from namespace 'build' or empty"
+
+    # Image Registration Name
+    name = params.get("name", None)
+    if not name:
+        raise Error(missing % 'name', status=400)
+    # User provided Image URL
+    src = params.get("src", None)
+    if not src:
+        raise Error(missing % 'src', status=400)
+
+    def check_dict_fields(name, value, fields):
+        if not value:
+            raise Error(missing % name, status=400)
+        if type(value) != dict:
+            raise Error('"%s" parameter is not a dictionary' % name,
+                        status=400)
+        for f in fields:
+            if f not in value:
+                raise Error('"%s" field missing from parameter: "%s"' %
+                            (f, name), status=400)
+    # Pithos image object
+    image = params.get("image", None)
+    check_dict_fields('image', image, ('container', 'object'))
+
+    # Pithos log object
+    log = params.get("log", None)
+    check_dict_fields('log', log, ('container', 'object'))
+
+    # Time in minutes the agent has to finish
+    timeout = params.get("timeout", None)
+    if timeout is not None:
+        timeout = _check_timeout(timeout, 'timeout')
+    # URL to POST to when the build finishes
+    callback = params.get("callback", None)
+    if callback is not None:
+        _check_callback(callback)
+
+    return {'name': name,
+            'src': src,
+            'image': image,
+            'log': log,
+            # Image description
+            'descr': params.get("description", None),
+            # Is the image public?
+            'public': params.get("public", False),
+            # Project to assign the agent VM to
+            'project': params.get("project", None),
+            # Networks of the agent VM
+            'networks': params.get("networks", None),
+            'timeout': timeout,
+            'callback': callback}
+
+
+def _new_build(user, params):
+    """Return a new build with the checked parameters of _parse_build()"""
+    build = Build(user.id, params['name'], params['descr'], params['public'],
+                  params['src'], None, params['image'], params['log'],
+                  params['timeout'])
+    build.callback = params['callback']
+    build.project = params['project']
+    return build
+
+
+def _quota_exceeded():
+    """Return the error for a build whose agent does not fit in the quota"""
+    return Error("The agent VM does not fit in the quota of the project",
+                 status=409)
+
+
+def _accepted(build):
+    """Return the status details of a new build"""
+    if build.status == 'QUEUED':
+        return "Build request queued"
+    return "Build request accepted"
+
+
 @builds.route('/icaas/builds', methods=['POST'])
 @login_required
 def create(user):
     """Create a new image with ICaaS"""
     logger.info("create build by user %s" % user.id)
 
-    token = request.headers["X-Auth-Token"]
-
     params = request.get_json()
     logger.debug("create build with params %s" % params)
     if params:
         params = params.get("build", None)
     else:
         raise Error('Required field "build" is missing')
+    params = _parse_build(params)
 
-    if params:
-        missing = "Parameter: '%s' is missing from namespace 'build' or empty"
-
-        # Image Registration Name
-        name = params.get("name", None)
-        if not name:
-            raise Error(missing % 'name', status=400)
-        # User provided Image URL
-        src = params.get("src", None)
-        if not src:
-            raise Error(missing % 'src', status=400)
-
-        def check_dict_fields(name, value, fields):
-            if not value:
-                raise Error(missing % name, status=400)
-            if type(value) != dict:
-                raise Error('"%s" parameter is not a dictionary' % name,
-                            status=400)
-            for f in fields:
-                if f not in value:
-                    raise Error('"%s" field missing from parameter: "%s"' %
-                                (f, name), status=400)
-        # Pithos image object
-        image = params.get("image", None)
-        check_dict_fields('image', image, ('container', 'object'))
-
-        # Pithos log object
-        log = params.get("log", None)
-        check_dict_fields('log', log, ('container', 'object'))
-
-        # Image description
-        descr = params.get("description", None)
-
-        # Is the image public?
-        public = params.get("public", False)
-
-        # Project to assign the agent VM to
-        project = params.get("project", None)
-        # Networks of the agent VM
-        networks = params.get("networks", None)
-    else:
-        fields = ['name', 'src', 'image', 'log']
-        raise Error('Required fields: "%s" are missing from namespace "build"'
-                    % '", "'.join(fields), status=400)
+    _check_pool(create_pool)
 
-    build = Build(user.id, name, descr, public, src, None, image, log)
-    _update_status_details(build, {'details': "Build request accepted"})
+    build = _new_build(user, params)
+    build.status, = jobs.admit(user, [build.project])
+    if build.status is None:
+        raise _quota_exceeded()
     db.session.add(build)
+    db.session.flush()
+    update_status_details(build, {'details': _accepted(build)})
+    job = jobs.enqueue(build, 'CREATE', project=params['project'],
+                       networks=params['networks'])
+    if build.status == 'QUEUED':
+        job.state = 'WAITING'
     db.session.commit()
     logger.debug('created build %r' % build.id)
 
-    # Check comment below to see why we are doing this
-    buildid = build.id
+    if build.status == 'CREATING':
+        jobs.dispatch(job)
 
-    @copy_current_request_context
-    def create_agent():
-        """Create ICaaS agent VM"""
+    response = jsonify({"build": _build_to_dict(build)})
+    response.status_code = 202
+    return response
 
-        # This is needed because the original build object is attached to the
-        # session of the father thread and any changes made to it from this
-        # thread won't be committed to the database using db.session.commit()
-        build = Build.query.filter_by(id=buildid,
-                                      deleted=False).first()  # noqa
-        if build is None:
-            # Normally this cannot happen
-            logger.error('Build with id=%d not found!' % build.id)
-            return
-
-        # Create the manifest URL
-        config = ConfigParser.ConfigParser()
-        config.add_section("manifest")
-        config.set("manifest", "url", "%s/builds/agent/%d/%s" %
-                   (settings.ENDPOINT, build.id, build.nonce))
-        manifest = StringIO.StringIO()
-        config.write(manifest)
-
-        personality = [
-            {'contents': b64encode(manifest.getvalue()), 'path': AGENT_CONFIG,
-             'owner': 'root', 'group': 'root', 'mode': 0600},
-            {'contents': b64encode("empty"), 'path': AGENT_INIT,
-             'owner': 'root', 'group': 'root', 'mode': 0600}]
-
-        compute = cyclades.CycladesComputeClient(settings.COMPUTE_URL, token)
-        date = datetime.now().strftime('%Y%m%d%H%M%S%f')
-        try:
-            agent = compute.create_server("icaas-agent-%s-%s" %
-                                          (build.id, date),
-                                          settings.AGENT_IMAGE_FLAVOR_ID,
-                                          settings.AGENT_IMAGE_ID,
-                                          project_id=project,
-                                          networks=networks,
-                                          personality=personality)
-        except ClientError as e:
-            build.status = 'ERROR'
-            msg = "ICaaS agent creation failed: (%d, %s)" % (e.status, e)
-            _update_status_details(build, {'details': msg})
-            db.session.commit()
-            logger.error("ICaaS agent creation failed: (%d, %s)"
-                         % (e.status, e))
-            return
-        except Exception as e:
-            build.status = 'ERROR'
-            params = {'details': "ICaaS agent creation failed"}
-            _update_status_details(build, params)
-            db.session.commit()
-            logger.error("ICaaS agent creation failed: %s" % e)
-            return
-
-        logger.debug("create new ICaaS agent vm: %s" % agent)
-        build.agent = agent['id']
-        build.agent_alive = True
-        params = {'details': "started ICaaS agent creation"}
-        _update_status_details(build, params)
-        db.session.commit()
 
-    thread = threading.Thread(target=create_agent,
-                              name="CreateAgentThread-%d" % build.id)
-    thread.daemon = False
+def _insert_builds(user, items, statuses):
+    """Insert many new builds with the statuses returned by jobs.admit()
+    along with their creation jobs at once and queue the jobs. Returns the
+    builds.
+    """
+    new = []
+    for params, status in zip(items, statuses):
+        build = _new_build(user, params)
+        build.status = status
+        build.status_details = json.dumps({'details': _accepted(build)})
+        new.append(build)
+    insert_all(new)
+
+    # Find out the IDs of the inserted builds by their unique nonces
+    ids = dict(db.session.query(Build.nonce, Build.id).filter(
+        Build.nonce.in_([b.nonce for b in new])))
+    for build in new:
+        build.id = ids[build.nonce]
+
+    insert_all([BuildEvent(b.id, b.user, b.status, _accepted(b))
+                for b in new])
+    queued = []
+    for b, params in zip(new, items):
+        job = Job(b.id, 'CREATE', {'project': params['project'],
+                                   'networks': params['networks']})
+        if b.status == 'QUEUED':
+            job.state = 'WAITING'
+        queued.append(job)
+    insert_all(queued)
+    jobids = [row[0] for row in db.session.query(Job.id).filter(
+        Job.build.in_(ids.values()), Job.action == 'CREATE',
+        Job.state == 'PENDING')]
+    db.session.commit()
+    logger.debug('created builds %r' % sorted(ids.values()))
 
-    response = jsonify({"build": _build_to_dict(build)})
-    response.status_code = 202
+    # The changes were not made through the session
+    notify.notify(('user', user.id))
+    jobs.dispatch_all(jobids, 'CREATE')
+    return new
 
-    thread.start()
+
+@builds.route('/icaas/builds/bulk', methods=['POST'])
+@login_required
+def bulk_create(user):
+    """Create many images with ICaaS at once. Each build is checked on its
+    own and the result of each one is returned in the order they were
+    submitted. The valid builds are inserted in a single transaction.
+    """
+    params = request.get_json()
+    if type(params) != dict or type(params.get("builds", None)) != list or \
+            not params["builds"]:
+        raise Error('Required field "builds" is missing or empty')
+    items = params["builds"]
+    if len(items) > int(settings.BULK_MAX_BUILDS):
+        raise Error('Up to %s builds may be submitted at once' %
+                    settings.BULK_MAX_BUILDS, status=400)
+    logger.info("bulk create of %d builds by user %s" %
+                (len(items), user.id))
+
+    results = [None] * len(items)
+    accepted = []
+    for i, item in enumerate(items):
+        try:
+            accepted.append((i, _parse_build(item)))
+        except Error as e:
+            results[i] = {"error": e.to_dict()}
+
+    if accepted:
+        _check_pool(create_pool)
+        statuses = jobs.admit(user, [item['project'] for i, item in accepted])
+        for (i, item), status in zip(accepted, statuses):
+            if status is None:
+                results[i] = {"error": _quota_exceeded().to_dict()}
+        accepted = [(i, item, status) for (i, item), status
+                    in zip(accepted, statuses) if status is not None]
+
+    new = []
+    if accepted:
+        new = _insert_builds(user, [item for i, item, _ in accepted],
+                             [status for i, item, status in accepted])
+    for build, (i, item, status) in zip(new, accepted):
+        results[i] = {"build": _build_to_dict(build)}
+
+    response = jsonify({"builds": results})
+    # Like a single request if no build was accepted
+    response.status_code = 202 if accepted else \
+        results[0]['error']['status']
     return response
 
 
+# Columns the builds may be sorted by
+SORT_KEYS = ('created', 'updated', 'name')
+
+
+def _check_limit(limit):
+    """Check if the page size provided by the user is valid"""
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = 0
+    if limit <= 0 or limit > int(settings.LIST_MAX_LIMIT):
+        raise Error("Invalid value for parameter 'limit'. It should be a "
+                    "number between 1 and %s" % settings.LIST_MAX_LIMIT,
+                    status=400)
+    return limit
+
+
+def _parse_timestamp(value, name):
+    """Parse an ISO 8601 UTC timestamp provided by the user"""
+    value = value.rstrip('Z')
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                '%a, %d %b %Y %H:%M:%S GMT'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise Error("Invalid value for parameter '%s'. It should be a timestamp "
+                "like 2015-09-23T09:57:47.123456" % name, status=400)
+
+
+def _check_ids(ids):
+    """Check the build IDs requested by the user and return them in order
+    without duplicates
+    """
+    try:
+        ids = [int(i) for i in ids.split(',')]
+    except ValueError:
+        ids = []
+    if not ids or len(ids) > int(settings.LIST_MAX_LIMIT):
+        raise Error("Invalid value for parameter 'id'. It should be a comma "
+                    "separated list of up to %s build IDs" %
+                    settings.LIST_MAX_LIMIT, status=400)
+
+    seen = set()
+    return [i for i in ids if not (i in seen or seen.add(i))]
+
+
+def _next_link(marker):
+    """Return the link to the next page of the builds listing"""
+    args = request.args.to_dict()
+    args['marker'] = marker
+    return {"href": "%s/builds?%s" % (settings.ENDPOINT,
+                                      urllib.urlencode(sorted(args.items()))),
+            "rel": "next"}
+
+
+def _listing_etag(user, blds, progress):
+    """Return the ETag of a page of the builds of a user. It changes when any
+    of the builds on the page changes and when the agents of the active ones
+    report progress.
+    """
+    tag = hashlib.sha1("%d-%s" % (user.id, request.query_string))
+    # Every change of a build, including its deletion, bumps its update time
+    for b in blds:
+        tag.update("-%d:%s" % (b.id, b.updated))
+        if b.id in progress:
+            tag.update(":%s" % progress[b.id].current)
+    return tag.hexdigest()
+
+
 @builds.route('/icaas/builds', methods=['GET'])
 @login_required
 def list_builds(user):
-    """List the builds owned by a user"""
+    """List the builds owned by a user. The builds are returned in pages of
+    `limit` builds. The next page starts after the build with ID `marker`.
+
+    If `changed_since` is specified, only the builds that changed after that
+    time are listed, including the ones that got deleted. The response then
+    contains the `watermark` to pass as `changed_since` next time.
+
+    If `id` is specified, only the builds with those IDs are listed and the
+    IDs of the ones that were not found are returned under `missing`.
+    """
     logger.info('list_builds by user %s' % user.id)
 
     # Check if status was provided
@@ -554,25 +1094,126 @@ def list_builds(user):
 
     # Check if details was provided
     details = request.args.get('details', '0')
+    if details not in ('0', '1'):
+        raise Error("Invalid value for parameter 'details'. Valid values are: "
+                    "'0' and '1'")
 
-    if not status:
-        blds = Build.query.filter_by(user=user.id, deleted=False).all()  # noqa
-    elif status.upper() in ('CREATING', 'ERROR', 'COMPLETED'):
-        blds = Build.query.filter_by(user=user.id, deleted=False,
-                                     status=status.upper()).all()  # noqa
+    # The attributes of the builds to return
+    fields = request.args.get('fields')
+    if fields is not None:
+        fields = _check_fields(fields)
+    elif details == '0':
+        fields = SHORT_FIELDS
     else:
-        raise Error("Invalid value for parameter 'status'. Valid values are: "
-                    "'CREATING', 'ERROR', 'COMPLETED'")
-
-    if details == '0':
-        result = [{"links": _build_to_links(b), "id": b.id, "name": b.name}
-                  for b in blds]
-    elif details == '1':
-        result = [_build_to_dict(b) for b in blds]
+        fields = FIELDS
+
+    sort = request.args.get('sort', 'created')
+    if sort not in SORT_KEYS:
+        raise Error("Invalid value for parameter 'sort'. Valid values are: "
+                    "'%s'" % "', '".join(SORT_KEYS))
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise Error("Invalid value for parameter 'order'. Valid values are: "
+                    "'asc' and 'desc'")
+    limit = _check_limit(request.args.get('limit',
+                                          settings.LIST_DEFAULT_LIMIT))
+
+    changed_since = request.args.get('changed_since')
+    if changed_since is not None:
+        changed_since = _parse_timestamp(changed_since, 'changed_since')
+        # Leave room for the transactions that are about to commit
+        watermark = datetime.utcnow() - \
+            timedelta(seconds=int(settings.WATERMARK_LAG))
+
+    ids = request.args.get('id')
+    if ids is not None:
+        ids = _check_ids(ids)
+
+    # Only load the columns of the requested attributes
+    query = db.session.query(*_columns(fields)) \
+        .filter(Build.user == user.id)
+
+    if ids is not None:
+        # Fetch all the requested builds at once
+        found = dict((b.id, b) for b in query.filter(
+            Build.id.in_(ids), Build.deleted == False))  # noqa
+        blds = [found[i] for i in ids if i in found]
+        progress = _progress(blds) if 'status_details' in fields else {}
+        etag = _listing_etag(user, blds, progress)
+        if request.if_none_match.contains_weak(etag):
+            return _not_modified(etag)
+        response = jsonify(
+            builds=[_build_to_dict(b, progress.get(b.id), fields)
+                    for b in blds],
+            missing=[i for i in ids if i not in found])
+        response.set_etag(etag, weak=True)
+        return response
+
+    if changed_since is None:
+        query = query.filter(Build.deleted == False)  # noqa
     else:
-        raise Error("Invalid value for parameter 'details'. Valid values are: "
-                    "'0' and '1'")
+        # Agent progress reports are only written to the build once in a
+        # while
+        reported = db.session.query(BuildProgress.build).filter(
+            BuildProgress.last_heartbeat > changed_since)
+        query = query.filter(or_(Build.updated > changed_since,
+                                 Build.id.in_(reported)))
+
+    if status:
+        if status.upper() not in ('QUEUED', 'CREATING', 'ERROR',
+                                  'COMPLETED'):
+            raise Error("Invalid value for parameter 'status'. Valid values "
+                        "are: 'QUEUED', 'CREATING', 'ERROR', 'COMPLETED'")
+        query = query.filter(Build.status == status.upper())
+
+    column = getattr(Build, sort)
+    marker = request.args.get('marker')
+    if marker is not None:
+        try:
+            last = db.session.query(column).filter(
+                Build.id == int(marker), Build.user == user.id).first()
+        except ValueError:
+            last = None
+        if last is None:
+            raise Error("Invalid value for parameter 'marker'", status=400)
+        if order == 'asc':
+            after = or_(column > last[0],
+                        and_(column == last[0], Build.id > int(marker)))
+        else:
+            after = or_(column < last[0],
+                        and_(column == last[0], Build.id < int(marker)))
+        query = query.filter(after)
 
-    return jsonify({"builds": result})
+    if order == 'asc':
+        query = query.order_by(column, Build.id)
+    else:
+        query = query.order_by(column.desc(), Build.id.desc())
+
+    # Fetch one more build to find out if there is a next page
+    blds = query.limit(limit + 1).all()
+    more = len(blds) > limit
+    page = blds[:limit]
+    last_id = page[-1].id if page else None
+
+    deleted = [{"links": _build_to_links(b), "id": b.id, "deleted": True}
+               for b in page if b.deleted]
+    page = [b for b in page if not b.deleted]
+    progress = _progress(page) if 'status_details' in fields else {}
+
+    etag = _listing_etag(user, blds, progress)
+    if request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+
+    result = [_build_to_dict(b, progress.get(b.id), fields) for b in page]
+
+    response = {"builds": result}
+    if changed_since is not None:
+        response["deleted"] = deleted
+        response["watermark"] = watermark.isoformat()
+    if more:
+        response["links"] = [_next_link(last_id)]
+    response = jsonify(response)
+    response.set_etag(etag, weak=True)
+    return response
 
 # vim: ai ts=4 sts=4 et sw=4 ft=python
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from flask import request, jsonify, Blueprint
+
+import logging
+
+from icaas.auth import token_cache, user_cache
+from icaas.reaper import heartbeat_lag
+from icaas import notify
+from icaas.error import Error
+from icaas.workers import pools
+from icaas import settings
+
+metrics = Blueprint('metrics', __name__)
+
+logger = logging.getLogger(__name__)
+
+
+@metrics.route('/icaas/metrics', methods=['GET'])
+def show_metrics():
+    """Show the metrics of this ICaaS worker process"""
+    if not settings.METRICS_TOKEN:
+        raise Error("Not found", status=404)
+    if request.headers.get("X-Metrics-Token") != settings.METRICS_TOKEN:
+        raise Error("Invalid metrics token", status=401)
+
+    result = {"token_cache": token_cache.stats(),
+              "user_cache": user_cache.stats(),
+              "pools": dict((p.name, p.stats()) for p in pools),
+              "heartbeat_lag": heartbeat_lag(),
+              "subscribers": notify.subscribers()}
+
+    return jsonify({"metrics": result})
+
+# vim: ai ts=4 sts=4 et sw=4 ft=python
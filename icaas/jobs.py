@@ -0,0 +1,673 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Module implementing the persistent queue of operations on the agent VMs.
+
+The jobs are added to the database in the same transaction that changes the
+state of a build. After the transaction is committed, they are executed by
+the worker pools of the process. Jobs that fail are retried with exponential
+backoff and jobs that are lost because a process died are picked up again
+once their lease expires.
+
+Jobs may also be executed by any number of dispatcher processes (see
+`icaas-manage dispatcher`) that share the load without running a job twice.
+
+When a build with a callback URL finishes, a job that POSTs the build to the
+URL is added to the transaction that finished it.
+
+The builds that exceed the concurrency limits of their user or project are
+QUEUED and their creation jobs wait. Whenever a running build finishes, the
+queued builds are started in round-robin order among their users. Builds
+whose agent does not fit in the Astakos quota of its project are rejected or
+queued as well, depending on QUOTA_EXCEEDED.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import hashlib
+import logging
+import signal
+import socket
+import hmac
+import time
+import json
+import urllib2
+import urlparse
+
+from sqlalchemy import and_, or_, event, func, inspect, text
+from sqlalchemy.orm import Session
+from kamaki.clients import ClientError
+
+from icaas.models import Build, Job, User, db
+from icaas.utils import (update_status_details, create_agent, find_agent,
+                         destroy_agent, add_event, check_callback_host)
+from icaas.workers import (WorkerPool, create_pool, destroy_pool,
+                           webhook_pool, PoolFull)
+from icaas import quotas
+from icaas import settings
+
+logger = logging.getLogger(__name__)
+
+
+class JobError(Exception):
+    """Raised when a job fails. Permanent failures are not retried."""
+
+    def __init__(self, message, permanent=False):
+        super(JobError, self).__init__(message)
+        self.permanent = permanent
+
+
+def enqueue(build, action, **params):
+    """Add a job for a build to the current database session. The job will
+    be stored when the session is committed.
+    """
+    job = Job(build.id, action, params)
+    db.session.add(job)
+    return job
+
+
+# The statuses of the builds that have not finished yet
+ACTIVE_STATUSES = ('QUEUED', 'CREATING')
+
+# The statuses of the builds that have finished
+FINAL_STATUSES = ('COMPLETED', 'ERROR', 'CANCELED')
+
+
+def _pool(action):
+    """Return the worker pool that executes the jobs of an action"""
+    return {'CREATE': create_pool,
+            'DESTROY': destroy_pool,
+            'NOTIFY': webhook_pool}[action]
+
+
+def dispatch(job):
+    """Execute a committed job in the background. This does nothing if the
+    jobs are only executed by dispatcher processes.
+    """
+    _submit(job.id, job.action)
+
+
+def dispatch_all(jobids, action):
+    """Execute many committed jobs of the same action in the background. The
+    jobs the worker pool cannot accept are executed later.
+    """
+    for jobid in jobids:
+        _submit(jobid, action)
+
+
+def _submit(jobid, action):
+    """Execute a committed job in the background, see dispatch()"""
+    if not settings.DISPATCH_IN_PROCESS:
+        return
+
+    try:
+        _pool(action).submit(run_job, jobid)
+    except PoolFull:
+        logger.warning('job %d will be executed later' % jobid)
+
+
+# Key of the PostgreSQL advisory lock held while starting queued builds
+PROMOTE_LOCK_KEY = 0x1caa6
+
+
+def lock_queue():
+    """Don't let other processes admit or start queued builds until the
+    current transaction ends. This only works on PostgreSQL.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'),
+                           {'key': PROMOTE_LOCK_KEY})
+
+
+def dequeue(buildids):
+    """Give up the jobs of some queued builds that will never start"""
+    if buildids:
+        Job.query.filter(Job.build.in_(buildids), Job.state == 'WAITING') \
+            .update({'state': 'DONE'}, synchronize_session=False)
+
+
+def _fits(users, projects, user, project):
+    """Returns True if one more build of a user, whose agent is assigned to
+    a project, may run next to the running builds counted by _running()
+    """
+    user_limit = int(settings.MAX_ACTIVE_BUILDS_PER_USER)
+    project_limit = int(settings.MAX_ACTIVE_BUILDS_PER_PROJECT)
+    if user_limit and users.get(user, 0) >= user_limit:
+        return False
+    return not (project and project_limit and
+                projects.get(project, 0) >= project_limit)
+
+
+def _take(users, projects, user, project):
+    """Count one more running build of a user and a project"""
+    users[user] = users.get(user, 0) + 1
+    if project:
+        projects[project] = projects.get(project, 0) + 1
+
+
+def _running(users, projects):
+    """Return the number of running builds of some users and projects,
+    indexed by the user and project ID respectively
+    """
+    def count(column, values):
+        if not values:
+            return {}
+        return dict(db.session.query(column, func.count(Build.id)).filter(
+            Build.status == 'CREATING', Build.deleted == False,  # noqa
+            column.in_(values)).group_by(column))
+
+    return count(Build.user, users), count(Build.project, projects)
+
+
+class _Room(object):
+    """The agent VMs that still fit in the quotas of the users, taking into
+    account the builds started so far. Only the cached quotas are used, see
+    quotas.warm().
+    """
+
+    def __init__(self):
+        self._room = {}
+
+    def fits(self, user, project):
+        """Returns True if one more agent fits in the quota of a project"""
+        key = (user.uuid, project)
+        if key not in self._room:
+            self._room[key] = quotas.room(user, project, fetch=False)
+        return self._room[key] is None or self._room[key] > 0
+
+    def take(self, user, project):
+        """Count one more agent in the quota of a project"""
+        key = (user.uuid, project)
+        if self._room.get(key) is not None:
+            self._room[key] -= 1
+        quotas.charge(user, project, 1)
+
+
+def admit(user, projects):
+    """Return the status of some new builds of a user, whose agents are
+    assigned to `projects`. The builds that may start right away are
+    CREATING and the rest are QUEUED. The new builds don't get ahead of the
+    queued builds of the same user or project. The builds whose agent does
+    not fit in the quota are None, if they are to be rejected. The queue is
+    locked until the new builds are committed.
+    """
+    # Ask Astakos before the other processes are kept waiting
+    quotas.warm([user])
+    # Don't let other processes count the same running builds
+    lock_queue()
+
+    named = set(p for p in projects if p)
+    competing = Build.user == user.id
+    if named:
+        competing = or_(competing, Build.project.in_(named))
+    waiting = db.session.query(Build.user, Build.project).filter(
+        Build.status == 'QUEUED', Build.deleted == False,  # noqa
+        competing).distinct().all()
+    behind = any(u == user.id for u, _ in waiting)
+    waiting = set(p for _, p in waiting)
+
+    users, counts = _running([user.id], named)
+    room = _Room()
+    statuses = []
+    for project in projects:
+        if not room.fits(user, project):
+            statuses.append('QUEUED' if settings.QUOTA_EXCEEDED == 'queue'
+                            else None)
+        elif behind or project in waiting or \
+                not _fits(users, counts, user.id, project):
+            statuses.append('QUEUED')
+        else:
+            statuses.append('CREATING')
+            _take(users, counts, user.id, project)
+            room.take(user, project)
+    return statuses
+
+
+def promote():
+    """Start the queued builds as long as the concurrency limits allow. The
+    users take turns, each one starting their oldest queued build. Returns
+    the number of builds that were started.
+    """
+    # Ask Astakos before the other processes are kept waiting
+    waiting = db.session.query(Build.user).filter(
+        Build.status == 'QUEUED', Build.deleted == False).distinct()  # noqa
+    quotas.warm(User.query.filter(User.id.in_(waiting)))
+
+    # Don't let other processes start builds at the same time
+    lock_queue()
+
+    query = db.session.query(Build.id, Build.user, Build.project).filter(
+        Build.status == 'QUEUED', Build.deleted == False)  # noqa
+    queued = OrderedDict()
+    for buildid, user, project in query.order_by(Build.created, Build.id):
+        queued.setdefault(user, []).append((buildid, project))
+    if not queued:
+        db.session.commit()
+        return 0
+
+    users, projects = _running(
+        queued.keys(),
+        set(p for builds in queued.values() for _, p in builds if p))
+    owners = dict((u.id, u) for u in
+                  User.query.filter(User.id.in_(queued.keys())))
+    room = _Room()
+
+    started = []
+    while queued:
+        for user in queued.keys():
+            builds = queued[user]
+            # The oldest build of the user that fits in its project
+            chosen = next((b for b in builds
+                           if _fits(users, projects, user, b[1]) and
+                           room.fits(owners[user], b[1])), None)
+            if chosen is None:
+                del queued[user]
+                continue
+            builds.remove(chosen)
+            if not builds:
+                del queued[user]
+            started.append(chosen[0])
+            _take(users, projects, user, chosen[1])
+            room.take(owners[user], chosen[1])
+
+    if not started:
+        db.session.commit()
+        return 0
+
+    for build in Build.query.filter(Build.id.in_(started),
+                                    Build.status == 'QUEUED'):
+        logger.info('starting queued build %d' % build.id)
+        build.start()
+        add_event(build, "Build started")
+    Job.query.filter(Job.build.in_(started), Job.state == 'WAITING').update(
+        {'state': 'PENDING', 'next_attempt': datetime.utcnow()},
+        synchronize_session=False)
+    jobids = [row[0] for row in db.session.query(Job.id).filter(
+        Job.build.in_(started), Job.action == 'CREATE',
+        Job.state == 'PENDING')]
+    db.session.commit()
+
+    dispatch_all(jobids, 'CREATE')
+    return len(started)
+
+
+def slots_freed():
+    """Start the queued builds in the background, now that some running
+    builds have finished
+    """
+    if not settings.DISPATCH_IN_PROCESS:
+        return
+
+    try:
+        create_pool.submit(promote)
+    except PoolFull:
+        logger.warning('queued builds will be started later')
+
+
+def _claimable(now):
+    """Returns the criterion for jobs that can be claimed"""
+    return or_(and_(Job.state == 'PENDING', Job.next_attempt <= now),
+               and_(Job.state == 'RUNNING', Job.locked_until < now))
+
+
+def _claim_values(now):
+    """Returns the values to set on the jobs that get claimed"""
+    return {'state': 'RUNNING',
+            'locked_until': now + timedelta(seconds=int(settings.JOB_LEASE)),
+            'attempts': Job.attempts + 1}
+
+
+def claim(jobid):
+    """Mark a job as running. Returns False if the job is not due or if it
+    has already been claimed by someone else.
+    """
+    now = datetime.utcnow()
+    count = Job.query.filter(Job.id == jobid, _claimable(now)).update(
+        _claim_values(now), synchronize_session=False)
+    db.session.commit()
+    return count == 1
+
+
+def claim_batch(limit):
+    """Claim up to `limit` jobs that are due and return their IDs"""
+    now = datetime.utcnow()
+    query = db.session.query(Job.id).filter(_claimable(now)) \
+        .order_by(Job.next_attempt).limit(limit)
+
+    if db.engine.dialect.name != 'postgresql':
+        # SKIP LOCKED is not available. Claim the jobs one by one.
+        jobids = [row[0] for row in query]
+        db.session.commit()
+        return [jobid for jobid in jobids if claim(jobid)]
+
+    # Rows locked by other dispatchers are skipped instead of waited for
+    jobids = [row[0] for row in query.with_for_update(skip_locked=True)]
+    if jobids:
+        Job.query.filter(Job.id.in_(jobids)).update(
+            _claim_values(now), synchronize_session=False)
+    db.session.commit()
+    return jobids
+
+
+def _agent_name(job):
+    """Return the name of the agent VM created by a job"""
+    return "icaas-agent-%d-%d" % (job.build, job.id)
+
+
+def _create(job, build):
+    """Create the agent VM of a build"""
+    if build.deleted or not build.is_active() or build.agent:
+        logger.info('no need to create an agent for build %d' % build.id)
+        if not build.agent:
+            # The build was canceled or deleted before its agent was created
+            _release(build)
+        return
+
+    user = User.query.filter_by(id=build.user).first()
+    params = json.loads(job.params)
+    name = _agent_name(job)
+
+    try:
+        agent = None
+        if job.attempts > 1:
+            # A previous attempt may have created the VM before failing
+            agent = find_agent(user.token, name)
+        if agent is None:
+            agent = create_agent(build, user.token, name,
+                                 params.get('project'),
+                                 params.get('networks'))
+    except ClientError as e:
+        msg = "ICaaS agent creation failed: (%d, %s)" % (e.status, e)
+        raise JobError(msg, permanent=400 <= e.status < 500)
+    except Exception as e:
+        raise JobError("ICaaS agent creation failed: %s" % e)
+
+    logger.debug("create new ICaaS agent vm: %s" % agent)
+    # The build may have been canceled or deleted in the meantime
+    db.session.refresh(build, with_for_update=True)
+    build.agent = agent['id']
+    build.agent_alive = True
+    if build.deleted or not build.is_active():
+        logger.info('build %d is over, destroying its new agent' % build.id)
+        destroy = enqueue(build, 'DESTROY')
+        db.session.flush()
+        db.session.info.setdefault('orphans', []).append(destroy.id)
+        return
+    update_status_details(build, {'details': "started ICaaS agent creation"})
+
+
+def _release(build):
+    """Give back the quota the agent of a build was charged when the build
+    was started
+    """
+    quotas.charge(User.query.get(build.user), build.project, -1)
+    if settings.CHECK_QUOTA:
+        # The queued builds may fit in the quota now
+        slots_freed()
+
+
+def _create_failed(job, build, message):
+    """Put a build whose agent could not be created to error state"""
+    if build.is_active():
+        build.status = 'ERROR'
+        update_status_details(build, {'details': message})
+    _release(build)
+
+
+def _destroy(job, build):
+    """Destroy the agent VM of a build"""
+    if not build.agent_alive:
+        logger.info('agent of build %d is not alive' % build.id)
+        return
+
+    if not destroy_agent(build):
+        raise JobError("ICaaS agent destruction failed")
+    _release(build)
+
+
+def _destroy_failed(job, build, message):
+    """Nothing else can be done if an agent cannot be destroyed"""
+    logger.error('giving up destroying the agent of build %d' % build.id)
+
+
+def _sign(body):
+    """Return the signature of a callback body"""
+    return 'sha256=' + hmac.new(settings.WEBHOOK_SECRET, body,
+                                hashlib.sha256).hexdigest()
+
+
+class _NoRedirect(urllib2.HTTPRedirectHandler):
+    """Don't follow the redirects of the callback receivers. Their targets
+    would not be checked.
+    """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+# Sends the callbacks
+_opener = urllib2.build_opener(_NoRedirect)
+
+
+def _notify(job, build):
+    """POST the build to its callback URL"""
+    params = json.loads(job.params)
+    details = build.status_details
+    body = json.dumps({"build": {
+        "id": build.id,
+        "name": build.name,
+        "status": params['status'],
+        "status_details": json.loads(details) if details else {}}})
+
+    # The address may have changed since the build was created
+    try:
+        check_callback_host(urlparse.urlparse(params['url']).hostname)
+    except ValueError as e:
+        raise JobError("Callback failed: %s" % e, permanent=True)
+    except socket.error as e:
+        raise JobError("Callback failed: %s" % e)
+
+    request = urllib2.Request(params['url'], body,
+                              {'Content-Type': 'application/json'})
+    if settings.WEBHOOK_SECRET:
+        request.add_header('X-Icaas-Signature', _sign(body))
+
+    try:
+        _opener.open(request,
+                     timeout=float(settings.WEBHOOK_TIMEOUT)).close()
+    except urllib2.HTTPError as e:
+        # The receiver refused or redirected the callback. Retrying will not
+        # help.
+        raise JobError("Callback failed: (%d, %s)" % (e.code, e.msg),
+                       permanent=300 <= e.code < 500 and
+                       e.code not in (408, 429))
+    except (urllib2.URLError, socket.error) as e:
+        raise JobError("Callback failed: %s" % e)
+
+
+def _notify_failed(job, build, message):
+    """Nothing else can be done if a callback cannot be delivered"""
+    logger.warning('giving up delivering the callback of build %d' %
+                   build.id)
+
+
+_HANDLERS = {'CREATE': (_create, _create_failed),
+             'DESTROY': (_destroy, _destroy_failed),
+             'NOTIFY': (_notify, _notify_failed)}
+
+
+@event.listens_for(Session, 'before_flush')
+def _queue_callbacks(session, flush_context, instances):
+    """Add a callback job for the builds that have just finished"""
+    for obj in session.dirty:
+        if not isinstance(obj, Build) or obj.status not in FINAL_STATUSES:
+            continue
+        if not inspect(obj).attrs.status.history.added or not obj.callback:
+            continue
+        session.add(Job(obj.id, 'NOTIFY',
+                        {'url': obj.callback, 'status': obj.status}))
+
+
+@event.listens_for(Session, 'before_flush')
+def _check_slots(session, flush_context, instances):
+    """Remember if a running build finished or got deleted"""
+    for obj in session.dirty:
+        if not isinstance(obj, Build):
+            continue
+        state = inspect(obj).attrs
+        if 'CREATING' in state.status.history.deleted or \
+                (state.deleted.history.added == [True] and
+                 obj.status == 'CREATING'):
+            session.info['slots_freed'] = True
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_callbacks(session, flush_context):
+    """Remember the callback jobs added in the current transaction"""
+    for obj in session.new:
+        if isinstance(obj, Job) and obj.action == 'NOTIFY':
+            session.info.setdefault('callbacks', []).append(obj.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _dispatch_callbacks(session):
+    """Deliver the callbacks and destroy the agents nobody needs once the
+    transaction is committed
+    """
+    for jobid in session.info.pop('callbacks', ()):
+        _submit(jobid, 'NOTIFY')
+    for jobid in session.info.pop('orphans', ()):
+        _submit(jobid, 'DESTROY')
+    if session.info.pop('slots_freed', False):
+        slots_freed()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_callbacks(session):
+    """The callback jobs are gone if the transaction was rolled back"""
+    session.info.pop('callbacks', None)
+    session.info.pop('orphans', None)
+    session.info.pop('slots_freed', None)
+
+
+def run_job(jobid):
+    """Claim and execute a job. Returns True if the job was executed"""
+    if not claim(jobid):
+        logger.debug('job %d is not due or claimed by someone else' % jobid)
+        return False
+
+    execute(jobid)
+    return True
+
+
+def execute(jobid):
+    """Execute a job that has been claimed"""
+    job = Job.query.filter_by(id=jobid).first()
+    build = Build.query.filter_by(id=job.build).first()
+    handler, on_failure = _HANDLERS[job.action]
+    logger.info('running job %d (%s build %d, attempt %d)' %
+                (job.id, job.action, job.build, job.attempts))
+
+    try:
+        if build is not None:
+            handler(job, build)
+    except Exception as e:
+        permanent = isinstance(e, JobError) and e.permanent
+        message = str(e)
+        logger.error('job %d failed: %s' % (jobid, message))
+
+        db.session.rollback()
+        job = Job.query.filter_by(id=jobid).first()
+        build = Build.query.filter_by(id=job.build).first()
+        job.last_error = message[:1024]
+
+        if permanent or job.attempts >= int(settings.JOB_MAX_ATTEMPTS):
+            job.state = 'FAILED'
+            on_failure(job, build, message)
+        else:
+            delay = min(int(settings.JOB_RETRY_DELAY) *
+                        2 ** (job.attempts - 1),
+                        int(settings.JOB_RETRY_MAX_DELAY))
+            job.state = 'PENDING'
+            job.next_attempt = datetime.utcnow() + timedelta(seconds=delay)
+            logger.info('job %d will be retried in %d seconds' %
+                        (jobid, delay))
+    else:
+        job.state = 'DONE'
+
+    job.locked_until = None
+    db.session.commit()
+
+
+def run_pending(limit):
+    """Execute the jobs that are due. Returns the number of executed jobs"""
+    jobids = claim_batch(limit)
+    for jobid in jobids:
+        execute(jobid)
+    return len(jobids)
+
+
+def run_dispatcher(workers, interval, exit_when_idle=False):
+    """Keep claiming the jobs that are due and execute them using a pool of
+    `workers` threads. No more jobs are claimed than the threads that are
+    available to execute them. The dispatcher stops on SIGTERM or SIGINT
+    after the claimed jobs are executed.
+    """
+    pool = WorkerPool('Dispatcher', workers, workers)
+    stopped = []
+
+    def stop(signum, frame):
+        logger.info('dispatcher stopping')
+        stopped.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopped:
+        stats = pool.stats()
+        available = pool.size - stats['active'] - stats['queued']
+        if available <= 0:
+            time.sleep(0.1)
+            continue
+
+        jobids = claim_batch(available)
+        for jobid in jobids:
+            pool.submit(execute, jobid)
+
+        if jobids:
+            continue
+
+        # Start the queued builds the running ones have made room for
+        if promote():
+            continue
+
+        if exit_when_idle:
+            # Jobs that are still executing may fail and become due again
+            pool.join()
+            if due_count() == 0:
+                break
+        else:
+            time.sleep(float(interval))
+
+    pool.shutdown()
+
+
+def due_count():
+    """Return the number of jobs that are due"""
+    return Job.query.filter(_claimable(datetime.utcnow())).count()
+
+# vim: ai ts=4 sts=4 et sw=4 ft=python
@@ -26,8 +26,12 @@ from flask.ext.script.commands import ShowUrls, Clean
 
 from icaas import settings
 from icaas import create_app
-from icaas.models import db, User, Build
-from icaas.utils import exec_on_timeout, destroy_agent
+from icaas.models import db, User, Build, Job
+from icaas.utils import exec_on_timeout
+from icaas.jobs import run_pending, run_dispatcher
+from icaas.reaper import reap, expire_manifests, expire_stalled, run_reaper
+from icaas.workers import WorkerPool
+from icaas.schema import upgrade
 
 manager = Manager(create_app)
 manager.add_command("showurls", ShowUrls())
@@ -46,7 +50,7 @@ manager.add_option('--log-level', metavar="LEVEL", dest='loglevel',
 
 @manager.shell
 def make_shell_context():
-    return dict(app=manager.app, db=db, User=User, Build=Build)
+    return dict(app=manager.app, db=db, User=User, Build=Build, Job=Job)
 
 
 @manager.command
@@ -55,6 +59,12 @@ def createdb():
     db.create_all()
 
 
+@manager.command
+def upgradedb():
+    """Upgrades the database of an existing ICaaS deployment"""
+    upgrade()
+
+
 @manager.option('-t', '--test-case', action='append', dest='names',
                 help='Run specific test cases', type=str)
 @manager.option('-s', '--show-tests', action='store_true', dest='show',
@@ -87,24 +97,59 @@ def showsettings():
 
 @manager.option('-d', '--dry-run', action='store_true',
                 help="don't destroy the timed out builds")
-@manager.option('-m', help='timeout period in minutes [%(default)d]',
-                default=settings.AGENT_TIMEOUT, metavar="MINUTES",
+@manager.option('-m', help='timeout period in minutes [the agent deadline of '
+                'each build]', default=None, metavar="MINUTES",
                 dest='minutes', type=int)
 def timeout(minutes, dry_run):
     """Put in error state all builds that are running for more than a specific
-    period of time
+    period of time or whose agent did not start up in time or has stalled
     """
 
-    def set_error(build):
-        """Put a build that timed out to error state"""
-        if build.status != 'COMPLETED':
-            build.status = 'ERROR'
-            build.status_details = 'timed out'
-            db.session.commit()
-        return destroy_agent(build)
+    if dry_run:
+        return exec_on_timeout(minutes, lambda build: True)
+
+    pool = WorkerPool('Reaper', settings.REAPER_WORKERS,
+                      settings.REAPER_CHUNK)
+    expire_manifests(int(settings.REAPER_CHUNK), pool)
+    expire_stalled(int(settings.REAPER_CHUNK), pool)
+    reap(int(settings.REAPER_CHUNK), pool, minutes)
+    pool.shutdown()
+
+
+@manager.option('-w', '--workers', help='number of agents to destroy in '
+                'parallel [%(default)s]', default=settings.REAPER_WORKERS,
+                metavar="NUMBER", type=int)
+@manager.option('-c', '--chunk', help='number of timed out builds to process '
+                'at once [%(default)s]', default=settings.REAPER_CHUNK,
+                metavar="NUMBER", type=int)
+def reaper(workers, chunk):
+    """Run a daemon that puts in error state the builds whose agent deadline
+    has passed, as soon as they time out
+    """
+    run_reaper(workers, chunk)
 
-    action = (lambda build: True) if dry_run else set_error
-    return exec_on_timeout(minutes, action)
+
+@manager.option('-l', '--limit', help='maximum number of jobs to run '
+                '[%(default)d]', default=100, metavar="NUMBER", type=int)
+def jobs(limit):
+    """Run the agent VM operations that are due. This includes the failed
+    operations that need to be retried and the ones that were lost.
+    """
+    count = run_pending(limit)
+    logging.info("%d jobs executed" % count)
+
+
+@manager.option('-w', '--workers', help='number of jobs to execute in '
+                'parallel [%(default)d]', default=4, metavar="NUMBER",
+                type=int)
+@manager.option('-i', '--interval', help='time to wait between polls when '
+                'there are no jobs [%(default)d]', default=2,
+                metavar="SECONDS", type=int)
+def dispatcher(workers, interval):
+    """Run a daemon that executes the agent VM operations. Any number of
+    dispatchers may run on different hosts, sharing the database.
+    """
+    run_dispatcher(workers, interval)
 
 
 if __name__ == "__main__":
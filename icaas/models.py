@@ -17,13 +17,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from flask.ext.sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import datetime, timedelta
 from uuid import uuid4
 from base64 import urlsafe_b64encode as b64encode
 
 
 import json
 
+from icaas import settings
+
 db = SQLAlchemy()
 
 
@@ -42,7 +44,7 @@ class Build(db.Model):
     public = db.Column(db.Boolean)
     # Build status
     status = db.Column(db.Enum('CREATING', 'ERROR', 'COMPLETED', 'CANCELED',
-                               name='status_types'),
+                               'QUEUED', name='status_types'),
                        default="CREATING", index=True)
     # ID of the ICaaS agent VM
     agent = db.Column(db.String(128))
@@ -72,11 +74,34 @@ class Build(db.Model):
     # Has the nonce been invalidated?
     nonce_invalid = db.Column(db.Boolean, default=False)
 
+    # The agent needs to retrieve the manifest before this time
+    manifest_deadline = db.Column(db.DateTime)
+
+    # The agent needs to finish before this time
+    agent_deadline = db.Column(db.DateTime)
+
+    # URL to POST to when the build finishes
+    callback = db.Column(db.String(1024))
+
+    # ID of the project the agent VM is assigned to
+    project = db.Column(db.String(256))
+
     # Index to be used to check if the agent VM timed out
-    __table_args__ = (db.Index('agent_alive_index', 'agent_alive', 'created'),)
+    __table_args__ = (db.Index('agent_alive_index', 'agent_alive', 'created'),
+                      # Indexes to be used to list the builds of a user
+                      db.Index('build_user_index', 'user', 'deleted',
+                               'created', 'id'),
+                      db.Index('build_user_status_index', 'user', 'deleted',
+                               'status', 'created', 'id'),
+                      # Index to be used to find the builds that changed
+                      db.Index('build_user_updated_index', 'user',
+                               'updated'))
 
-    def __init__(self, user, name, descr, public, src, agent, image, log):
-        """Initialize a Build object"""
+    def __init__(self, user, name, descr, public, src, agent, image, log,
+                 timeout=None):
+        """Initialize a Build object. The agent will have `timeout` minutes
+        to finish, or AGENT_TIMEOUT if this is not specified.
+        """
 
         assert type(image) == dict
         assert type(log) == dict
@@ -92,9 +117,51 @@ class Build(db.Model):
         self.token = str(uuid4()).replace('-', '')
         self.nonce = b64encode(uuid4().bytes + uuid4().bytes).strip('=')
 
+        self.created = datetime.utcnow()
+        self.manifest_deadline = self.created + \
+            timedelta(minutes=int(settings.MANIFEST_TIMEOUT))
+        if timeout is None:
+            timeout = int(settings.AGENT_TIMEOUT)
+        self.agent_deadline = self.created + timedelta(minutes=timeout)
+
+    def get_manifest_deadline(self):
+        """Return the time the agent needs to retrieve the manifest by. The
+        builds created before the deadlines were recorded get
+        MANIFEST_TIMEOUT minutes from their creation.
+        """
+        if self.manifest_deadline is None:
+            return self.created + \
+                timedelta(minutes=int(settings.MANIFEST_TIMEOUT))
+        return self.manifest_deadline
+
+    def get_agent_deadline(self):
+        """Return the time the agent needs to finish by. The builds created
+        before the deadlines were recorded get AGENT_TIMEOUT minutes from
+        their creation.
+        """
+        if self.agent_deadline is None:
+            return self.created + \
+                timedelta(minutes=int(settings.AGENT_TIMEOUT))
+        return self.agent_deadline
+
+    def extend_deadline(self, minutes):
+        """Give the agent some more minutes to finish"""
+        self.agent_deadline = self.get_agent_deadline() + \
+            timedelta(minutes=minutes)
+
     def is_active(self):
         """Returns True if the build has not finished yet"""
-        return self.status == 'CREATING'
+        return self.status in ('QUEUED', 'CREATING')
+
+    def start(self):
+        """Start a queued build. The agent gets the time it was given
+        counting from now.
+        """
+        now = datetime.utcnow()
+        self.status = 'CREATING'
+        self.manifest_deadline = now + \
+            timedelta(minutes=int(settings.MANIFEST_TIMEOUT))
+        self.agent_deadline = now + (self.get_agent_deadline() - self.created)
 
     @classmethod
     def get_status_types(cls):
@@ -105,6 +172,145 @@ class Build(db.Model):
         return '<Build: id %s, name %s>' % (self.id, self.name)
 
 
+def _partial_index(name, column, where):
+    """Create an index that only covers the rows matching a criterion"""
+    return db.Index(name, column, postgresql_where=where, sqlite_where=where)
+
+# Only a handful of builds are active at any time. The indexes used by the
+# reaper only cover them.
+_partial_index('build_agent_deadline_index', Build.agent_deadline,
+               Build.agent_alive == True)  # noqa
+_partial_index('build_manifest_deadline_index', Build.manifest_deadline,
+               db.and_(Build.status == 'CREATING',
+                       Build.nonce_invalid == False))  # noqa
+_partial_index('build_active_index', Build.id, Build.status == 'CREATING')
+_partial_index('build_queued_index', Build.created, Build.status == 'QUEUED')
+
+
+class BuildProgress(db.Model):
+    """Represents the reports of the ICaaS agent of a build. This is kept
+    apart from the build, so that frequent reports only update a narrow row.
+    The progress is written to the build only once in a while.
+    """
+    __tablename__ = 'build_progress'
+    # Build ID
+    build = db.Column(db.Integer, db.ForeignKey('build.id'), primary_key=True)
+    # The last time the agent reported back
+    last_heartbeat = db.Column(db.DateTime, default=datetime.utcnow,
+                               index=True)
+    # The last progress reported by the agent
+    current = db.Column(db.Integer)
+    total = db.Column(db.Integer)
+    # The last time the progress was written to the status details of the
+    # build
+    flushed = db.Column(db.DateTime)
+
+    def __init__(self, build):
+        """Initialize a BuildProgress object"""
+        self.build = build
+        self.last_heartbeat = datetime.utcnow()
+
+    def to_dict(self):
+        """Returns the progress in the format used in the status details"""
+        return {'current': self.current, 'total': self.total}
+
+    def __repr__(self):
+        return '<BuildProgress: build %s, last heartbeat %s>' % \
+            (self.build, self.last_heartbeat)
+
+
+class BuildEvent(db.Model):
+    """Represents a change in the status of a build. Events are only ever
+    appended, so that the timeline of a build is kept.
+    """
+    __tablename__ = 'build_event'
+    # Unique event ID. It increases with time.
+    id = db.Column(db.Integer, primary_key=True)
+    # Build ID
+    build = db.Column(db.Integer, db.ForeignKey('build.id'))
+    # User ID of the build owner
+    user = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # Event time
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    # Build status after the event
+    status = db.Column(db.String(16))
+    # Detailed description of the event
+    details = db.Column(db.String(1024))
+    # The progress reported by the agent
+    current = db.Column(db.Integer)
+    total = db.Column(db.Integer)
+
+    # Indexes to be used to fetch the timeline of a build or a user
+    __table_args__ = (db.Index('build_event_index', 'build', 'id'),
+                      db.Index('build_event_user_index', 'user', 'id'))
+
+    def __init__(self, build, user, status, details=None, progress=None):
+        """Initialize a BuildEvent object"""
+        self.build = build
+        self.user = user
+        self.created = datetime.utcnow()
+        self.status = status
+        self.details = details[:1024] if details else None
+        if progress:
+            self.current = progress['current']
+            self.total = progress['total']
+
+    def __repr__(self):
+        return '<BuildEvent: id %s, build %s, status %s>' % (self.id,
+                                                             self.build,
+                                                             self.status)
+
+
+class Job(db.Model):
+    """Represents an operation on the ICaaS agent VM of a build or the
+    delivery of its completion callback
+    """
+    __tablename__ = 'job'
+    # Unique job ID
+    id = db.Column(db.Integer, primary_key=True, index=True)
+    # Build ID
+    build = db.Column(db.Integer, db.ForeignKey('build.id'), index=True)
+    # What to do with the agent VM
+    action = db.Column(db.Enum('CREATE', 'DESTROY', 'NOTIFY',
+                               name='job_actions'))
+    # Job state. The creation jobs of queued builds wait until the builds
+    # are started.
+    state = db.Column(db.Enum('PENDING', 'RUNNING', 'DONE', 'FAILED',
+                              'WAITING', name='job_states'),
+                      default='PENDING')
+    # Action specific parameters encoded in JSON
+    params = db.Column(db.String(4096), default='{}')
+    # Number of times the job has been tried
+    attempts = db.Column(db.Integer, default=0)
+    # Don't try the job before this time
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow)
+    # A running job whose lease has expired may be claimed again
+    locked_until = db.Column(db.DateTime)
+    # The error of the last attempt
+    last_error = db.Column(db.String(1024))
+    # Job creation time
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    # Job update time
+    updated = db.Column(db.DateTime, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
+
+    # Index to be used to find the jobs that are due
+    __table_args__ = (db.Index('job_due_index', 'state', 'next_attempt'),)
+
+    def __init__(self, build, action, params=None):
+        """Initialize a Job object"""
+        self.build = build
+        self.action = action
+        self.params = json.dumps(params or {})
+        self.state = 'PENDING'
+        self.attempts = 0
+        self.next_attempt = datetime.utcnow()
+
+    def __repr__(self):
+        return '<Job: id %s, action %s, build %s>' % (self.id, self.action,
+                                                      self.build)
+
+
 class User(db.Model):
     """Represents the User model"""
     __tablename__ = 'user'
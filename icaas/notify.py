@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Module for waking up the requests that wait for builds to change.
+
+The requests subscribe to a key: ('build', <build ID>) to watch a build or
+('user', <user ID>) to watch the events of all the builds of a user. The
+changes committed by this process are announced to the subscribers right
+away. The events added by other processes are picked up by a thread that
+checks the database once in a while, so that the subscribers don't need to.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from icaas.models import Build, BuildEvent, db
+from icaas import settings
+
+logger = logging.getLogger(__name__)
+
+# The events of the subscribers, indexed by their key
+_subscribers = {}
+_lock = threading.Lock()
+
+
+def subscribe(key):
+    """Return an event that is set every time something changes for a key"""
+    _poller.start()
+    changed = threading.Event()
+    with _lock:
+        _subscribers.setdefault(key, set()).add(changed)
+    return changed
+
+
+def unsubscribe(key, changed):
+    """Stop setting an event returned by subscribe()"""
+    with _lock:
+        events = _subscribers.get(key, set())
+        events.discard(changed)
+        if not events:
+            _subscribers.pop(key, None)
+
+
+def notify(key):
+    """Wake up the subscribers of a key"""
+    with _lock:
+        events = list(_subscribers.get(key, ()))
+    for changed in events:
+        changed.set()
+
+
+def subscribers():
+    """Return the number of subscribers"""
+    with _lock:
+        return sum(len(events) for events in _subscribers.values())
+
+
+class EventCursor(object):
+    """Pages through the build events by ID. The IDs are taken when the
+    events are added but the events only show up when their transaction
+    commits, not necessarily in order. So the events seen in the last
+    WATERMARK_LAG seconds are scanned again and the ones seen are skipped.
+    """
+
+    def __init__(self, last):
+        # All the events up to this ID are assumed to be committed
+        self._floor = last
+        # The time the events after the floor were seen, indexed by their ID
+        self._seen = {}
+
+    def _settle(self):
+        """Move the floor past the events seen long enough ago"""
+        settled = time.time() - float(settings.WATERMARK_LAG)
+        for eventid, seen in self._seen.items():
+            if seen < settled:
+                self._floor = max(self._floor, eventid)
+        self._seen = dict((i, t) for i, t in self._seen.items()
+                          if i > self._floor)
+
+    def fetch(self, query):
+        """Return the next page of the events of `query` that were not seen
+        yet. The query should select BuildEvent.id.
+        """
+        self._settle()
+        page = int(settings.EVENTS_PAGE_SIZE)
+        after = self._floor
+        rows = []
+        while len(rows) < page:
+            scanned = query.filter(BuildEvent.id > after) \
+                .order_by(BuildEvent.id).limit(page).all()
+            rows.extend(r for r in scanned if r.id not in self._seen)
+            if len(scanned) < page:
+                break
+            after = scanned[-1].id
+        rows = rows[:page]
+
+        now = time.time()
+        for row in rows:
+            self._seen[row.id] = now
+        return rows
+
+
+class _Poller(object):
+    """A thread announcing the build events added by other processes"""
+
+    def __init__(self):
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the thread unless it is already running. This is done
+        lazily to play well with servers that fork after importing the
+        application.
+        """
+        if float(settings.EVENT_POLL_INTERVAL) <= 0:
+            return
+
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and \
+                    self._thread.is_alive():
+                return
+            app = current_app._get_current_object()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, args=(app,),
+                                            name="NotifyPoller")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _poll(self, cursor):
+        """Announce the events that were not seen by `cursor` yet"""
+        query = db.session.query(BuildEvent.id, BuildEvent.build,
+                                 BuildEvent.user)
+        rows = cursor.fetch(query)
+        keys = set()
+        for _, buildid, userid in rows:
+            keys.add(('build', buildid))
+            keys.add(('user', userid))
+        for key in keys:
+            notify(key)
+
+    def _run(self, app):
+        """The main loop of the poller"""
+        cursor = None
+        while True:
+            try:
+                with app.app_context():
+                    if cursor is None:
+                        cursor = EventCursor(db.session.query(
+                            func.max(BuildEvent.id)).scalar() or 0)
+                    self._poll(cursor)
+                    db.session.remove()
+            except Exception:
+                logger.exception("checking for new build events failed")
+            threading.Event().wait(float(settings.EVENT_POLL_INTERVAL))
+
+# The poller of this process
+_poller = _Poller()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect(session, flush_context):
+    """Remember the builds that changed in the current transaction"""
+    changed = session.info.setdefault('changed_builds', set())
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Build):
+            changed.add(('build', obj.id))
+        elif isinstance(obj, BuildEvent):
+            changed.add(('build', obj.build))
+            changed.add(('user', obj.user))
+
+
+@event.listens_for(Session, 'after_commit')
+def _announce(session):
+    """Announce the builds that changed once the transaction is committed"""
+    for key in session.info.pop('changed_builds', ()):
+        notify(key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget(session):
+    """Nothing changed if the transaction was rolled back"""
+    session.info.pop('changed_builds', None)
+
+# vim: ai ts=4 sts=4 et sw=4 ft=python
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Module for checking the Astakos quotas of the users before their agent VMs
+are created.
+
+The quotas of a user are fetched from Astakos and cached for a short while.
+The cached usage is updated as this process admits builds and destroys their
+agents, so that Astakos is not asked on every request.
+"""
+
+import logging
+import threading
+
+import astakosclient
+
+from icaas.cache import TTLCache
+from icaas import settings
+
+logger = logging.getLogger(__name__)
+
+# The quotas of the users indexed by their Synnefo UUID
+quota_cache = TTLCache(settings.QUOTA_CACHE_SIZE, settings.QUOTA_CACHE_TTL)
+
+# Serializes the updates of the cached usage
+_lock = threading.Lock()
+
+
+def _quotas(user):
+    """Return the quotas of all the projects of a user"""
+    quotas = quota_cache.get(user.uuid)
+    if quotas is None:
+        astakos = astakosclient.AstakosClient(user.token, settings.AUTH_URL)
+        quotas = astakos.get_quotas()
+        quota_cache.set(user.uuid, quotas)
+    return quotas
+
+
+def warm(users):
+    """Fetch the quotas of some users that are not in the cache, so that
+    room() does not wait for Astakos
+    """
+    if not settings.CHECK_QUOTA:
+        return
+
+    for user in users:
+        try:
+            _quotas(user)
+        except Exception as e:
+            logger.warning("failed to get the quotas of user %s: %s" %
+                           (user.uuid, e))
+
+
+def room(user, project, fetch=True):
+    """Return the number of agent VMs that fit in the quota the user has on a
+    project, or None if this is not known. The base project of the user is
+    used if `project` is None. Astakos is not asked if `fetch` is False.
+    """
+    if not settings.CHECK_QUOTA:
+        return None
+
+    if fetch:
+        try:
+            quotas = _quotas(user)
+        except Exception as e:
+            # Let the agent creation find out
+            logger.warning("failed to get the quotas of user %s: %s" %
+                           (user.uuid, e))
+            return None
+    else:
+        quotas = quota_cache.get(user.uuid)
+        if quotas is None:
+            return None
+
+    resources = quotas.get(project or user.uuid)
+    if resources is None:
+        return None
+
+    fits = []
+    for resource, amount in settings.AGENT_QUOTA.items():
+        quota = resources.get(resource)
+        if quota is None or int(amount) <= 0:
+            continue
+        free = quota['limit'] - quota['usage'] - quota.get('pending', 0)
+        # The project may run out before the share of the user does
+        if 'project_limit' in quota:
+            free = min(free, quota['project_limit'] -
+                       quota['project_usage'] -
+                       quota.get('project_pending', 0))
+        fits.append(max(free // int(amount), 0))
+    return min(fits) if fits else None
+
+
+def charge(user, project, count):
+    """Add `count` agent VMs to the cached usage of a project of a user. A
+    negative count removes them.
+    """
+    with _lock:
+        quotas = quota_cache.get(user.uuid)
+        if quotas is None:
+            return
+        resources = quotas.get(project or user.uuid, {})
+        for resource, amount in settings.AGENT_QUOTA.items():
+            quota = resources.get(resource)
+            if quota is None:
+                continue
+            quota['usage'] += int(amount) * count
+            if 'project_usage' in quota:
+                quota['project_usage'] += int(amount) * count
+
+# vim: ai ts=4 sts=4 et sw=4 ft=python
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Module implementing the reaper that destroys the agent VMs of the builds
+that have run out of time or whose agent has stalled
+"""
+
+from datetime import datetime, timedelta
+import logging
+import signal
+import threading
+
+from sqlalchemy import and_, exists, func, text
+
+from icaas.models import Build, BuildProgress, Job, db
+from icaas.utils import update_status_details
+from icaas.workers import WorkerPool
+from icaas import jobs
+from icaas import settings
+
+logger = logging.getLogger(__name__)
+
+# Key of the PostgreSQL advisory lock held by the active reaper
+LOCK_KEY = 0x1caa5
+
+
+def _lock():
+    """Take the advisory lock of the reaper. Returns the database connection
+    that holds the lock or None if another reaper holds it.
+    """
+    conn = db.engine.connect()
+    if db.engine.dialect.name != 'postgresql':
+        logger.warning('advisory locks are only supported on PostgreSQL, make '
+                       'sure only one reaper is running')
+        return conn
+
+    if conn.execute(text('SELECT pg_try_advisory_lock(:key)'),
+                    key=LOCK_KEY).scalar():
+        return conn
+
+    conn.close()
+    return None
+
+
+def _alive():
+    """Returns the criterion for builds whose agent needs to be destroyed
+    and nobody is taking care of it
+    """
+    destroying = exists().where(and_(Job.build == Build.id,
+                                     Job.action == 'DESTROY',
+                                     Job.state.in_(('PENDING', 'RUNNING'))))
+    return and_(Build.agent_alive == True, ~destroying)  # noqa
+
+
+def _destroy_agents(builds, pool):
+    """Queue the destruction of the agents of some builds, commit and wait
+    for the threads of the pool to destroy them in parallel
+    """
+    queued = [jobs.enqueue(build, 'DESTROY') for build in builds]
+    db.session.flush()
+    jobids = [job.id for job in queued]
+    db.session.commit()
+
+    for jobid in jobids:
+        pool.submit(jobs.run_job, jobid)
+    pool.join()
+
+
+def reap(chunk, pool, timeout=None):
+    """Put the builds that have timed out to error state and destroy their
+    agents. The builds are processed in chunks and the agents of each chunk
+    are destroyed in parallel by the threads of the pool. Returns the number
+    of builds that have timed out.
+
+    A build times out when its agent deadline passes. If `timeout` is
+    specified, the builds created more than `timeout` minutes ago are
+    considered timed out instead.
+    """
+    now = datetime.utcnow()
+    if timeout is None:
+        expired = Build.agent_deadline < now
+    else:
+        expired = Build.created < now - timedelta(minutes=timeout)
+
+    count = 0
+    last = 0
+    while True:
+        builds = Build.query.filter(_alive(), expired, Build.id > last) \
+            .order_by(Build.id).limit(chunk).all()
+        if not builds:
+            break
+
+        for build in builds:
+            logger.info("Build %d timed out" % build.id)
+            if build.is_active():
+                build.status = 'ERROR'
+                update_status_details(build, {'details': 'timed out'})
+
+        last = builds[-1].id
+        count += len(builds)
+        _destroy_agents(builds, pool)
+
+    return count
+
+
+def _manifest_expired(now):
+    """Returns the criterion for the builds whose agent did not retrieve the
+    manifest in time
+    """
+    return and_(Build.status == 'CREATING',
+                Build.nonce_invalid == False,  # noqa
+                Build.manifest_deadline < now)
+
+
+def expire_manifests(chunk, pool):
+    """Put the builds whose agent did not retrieve the manifest in time to
+    error state and destroy their agents. Returns the number of such builds.
+    """
+    now = datetime.utcnow()
+    count = 0
+    last = 0
+    while True:
+        builds = Build.query.filter(_manifest_expired(now), Build.id > last) \
+            .order_by(Build.id).limit(chunk).all()
+        if not builds:
+            break
+
+        for build in builds:
+            logger.info("Agent of build %d did not start up in time" %
+                        build.id)
+            build.nonce_invalid = True
+            build.status = 'ERROR'
+            update_status_details(build,
+                                  {'details': 'Agent start up expired'})
+
+        last = builds[-1].id
+        count += len(builds)
+        _destroy_agents([b for b in builds if b.agent_alive], pool)
+
+    return count
+
+
+def stall_timeout():
+    """Return the time after which an agent that has not reported back is
+    considered stalled
+    """
+    return timedelta(seconds=int(settings.AGENT_STALL_INTERVALS) *
+                     int(settings.PROGRESS_INTERVAL))
+
+
+def _reporting():
+    """Returns the criterion for the builds whose agent is expected to report
+    back periodically
+    """
+    return and_(Build.status == 'CREATING',
+                Build.nonce_invalid == True,  # noqa
+                BuildProgress.build == Build.id)
+
+
+def expire_stalled(chunk, pool):
+    """Put the builds whose agent has stopped reporting back to error state
+    and destroy their agents. Returns the number of such builds.
+    """
+    stalled = BuildProgress.last_heartbeat < datetime.utcnow() - \
+        stall_timeout()
+    count = 0
+    last = 0
+    while True:
+        builds = Build.query.filter(_reporting(), stalled, Build.id > last) \
+            .order_by(Build.id).limit(chunk).all()
+        if not builds:
+            break
+
+        for build in builds:
+            logger.info("Agent of build %d stopped reporting back" % build.id)
+            build.status = 'ERROR'
+            update_status_details(build,
+                                  {'details': 'Agent stopped responding'})
+
+        last = builds[-1].id
+        count += len(builds)
+        _destroy_agents([b for b in builds if b.agent_alive], pool)
+
+    return count
+
+
+def heartbeat_lag():
+    """Return the time -in seconds- since the agents of the active builds
+    last reported back
+    """
+    count, oldest, newest = db.session.query(
+        func.count(Build.id), func.min(BuildProgress.last_heartbeat),
+        func.max(BuildProgress.last_heartbeat)).filter(_reporting()).one()
+
+    now = datetime.utcnow()
+    stalled = db.session.query(func.count(Build.id)).filter(
+        _reporting(),
+        BuildProgress.last_heartbeat < now - stall_timeout()).scalar()
+    db.session.commit()
+
+    return {"builds": count,
+            "stalled": stalled,
+            "max": (now - oldest).total_seconds() if oldest else 0,
+            "min": (now - newest).total_seconds() if newest else 0}
+
+
+def _next_wakeup():
+    """Return the number of seconds until the next build times out"""
+    agent = db.session.query(func.min(Build.agent_deadline)) \
+        .filter(_alive()).scalar()
+    manifest = db.session.query(func.min(Build.manifest_deadline)) \
+        .filter(Build.status == 'CREATING',
+                Build.nonce_invalid == False).scalar()  # noqa
+    heartbeat = db.session.query(func.min(BuildProgress.last_heartbeat)) \
+        .filter(_reporting()).scalar()
+    db.session.commit()
+
+    if heartbeat is not None:
+        heartbeat += stall_timeout()
+
+    max_sleep = float(settings.REAPER_MAX_SLEEP)
+    deadlines = [d for d in (agent, manifest, heartbeat) if d is not None]
+    if not deadlines:
+        return max_sleep
+
+    delay = (min(deadlines) - datetime.utcnow()).total_seconds()
+    return min(max(delay, 1), max_sleep)
+
+
+def run_reaper(workers, chunk):
+    """Keep destroying the agents of the builds that have timed out. The
+    reaper sleeps until the next build is about to time out. Only one reaper
+    is active at a time, the rest wait for the lock.
+    """
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        logger.info('reaper stopping')
+        stopped.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    pool = WorkerPool('Reaper', workers, chunk)
+    conn = None
+    while not stopped.is_set():
+        if conn is None:
+            conn = _lock()
+            if conn is None:
+                logger.debug('another reaper is active')
+                stopped.wait(float(settings.REAPER_MAX_SLEEP))
+                continue
+            logger.info('reaper is active')
+
+        count = expire_manifests(chunk, pool)
+        if count:
+            logger.info('%d agents did not start up in time' % count)
+        count = expire_stalled(chunk, pool)
+        if count:
+            logger.info('%d agents stopped reporting back' % count)
+        count = reap(chunk, pool)
+        if count:
+            logger.info('%d builds timed out' % count)
+        stopped.wait(_next_wakeup())
+
+    pool.shutdown()
+    if conn is not None:
+        conn.close()
+
+# vim: ai ts=4 sts=4 et sw=4 ft=python
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Module for bringing the database of an existing deployment up to date"""
+
+from datetime import timedelta
+import logging
+
+from sqlalchemy import Enum, inspect, or_, text
+
+from icaas.models import Build, db
+from icaas import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _add_column(engine, table, column):
+    """Add a missing column to an existing table"""
+    if isinstance(column.type, Enum):
+        column.type.create(bind=engine, checkfirst=True)
+
+    preparer = engine.dialect.identifier_preparer
+    engine.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                   (preparer.format_table(table),
+                    preparer.format_column(column),
+                    column.type.compile(dialect=engine.dialect)))
+
+
+def _add_enum_values(engine):
+    """Add the missing values to the existing enum types. Only PostgreSQL has
+    enum types, the other databases check the values of the columns with
+    constraints that are not updated.
+    """
+    if engine.dialect.name != 'postgresql':
+        return
+
+    preparer = engine.dialect.identifier_preparer
+    # ALTER TYPE ... ADD VALUE cannot run inside a transaction block
+    conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        for table in db.metadata.sorted_tables:
+            for column in table.columns:
+                if not isinstance(column.type, Enum):
+                    continue
+                name = column.type.name
+                existing = set(row[0] for row in conn.execute(
+                    text("SELECT e.enumlabel FROM pg_enum e JOIN pg_type t "
+                         "ON e.enumtypid = t.oid WHERE t.typname = :name"),
+                    name=name))
+                for value in column.type.enums:
+                    if value not in existing:
+                        logger.info('adding value %s to type %s' %
+                                    (value, name))
+                        conn.execute("ALTER TYPE %s ADD VALUE '%s'" %
+                                     (preparer.quote(name), value))
+                        existing.add(value)
+    finally:
+        conn.close()
+
+
+def _backfill_deadlines():
+    """Set the deadlines of the unfinished builds that were created before
+    the deadlines were introduced
+    """
+    builds = Build.query.filter(or_(Build.manifest_deadline == None,  # noqa
+                                    Build.agent_deadline == None),  # noqa
+                                or_(Build.status == 'CREATING',
+                                    Build.agent_alive == True))  # noqa
+    for build in builds:
+        build.manifest_deadline = build.created + \
+            timedelta(minutes=int(settings.MANIFEST_TIMEOUT))
+        build.agent_deadline = build.created + \
+            timedelta(minutes=int(settings.AGENT_TIMEOUT))
+
+
+# Functions that fill in the columns added to existing tables. They need to
+# be safe to run more than once.
+BACKFILLS = [_backfill_deadlines]
+
+
+def upgrade():
+    """Create the missing tables, columns and indexes of the database"""
+    engine = db.engine
+    db.create_all()
+    _add_enum_values(engine)
+
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                logger.info('adding column %s.%s' % (table.name, column.name))
+                _add_column(engine, table, column)
+
+        indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                logger.info('creating index %s' % index.name)
+                index.create(engine)
+
+    for backfill in BACKFILLS:
+        backfill()
+    db.session.commit()
+
+# vim: ai ts=4 sts=4 et sw=4 ft=python
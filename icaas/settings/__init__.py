@@ -18,6 +18,7 @@
 modules access the settings by importing this one.
 """
 
+import json
 import os
 import sys
 
@@ -33,9 +34,28 @@ if os.path.exists(CONFIG):
                          % (CONFIG, e))
         raise SystemExit(1)
 
+
+def from_env(default, value):
+    """Convert the value of an environment variable to the type of the
+    default value of a setting. Numbers are converted where they are used.
+    """
+    if isinstance(default, bool):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, dict):
+        # e.g. ICAAS_AGENT_QUOTA='{"cyclades.vm": 1, "cyclades.cpu": 2}'
+        return json.loads(value)
+    return value
+
+
 # Overwrite the value of a setting if the environment variable
 # ICAAS_SETTINGNAME is defined.
 for i in [var for var in os.environ if var.startswith("ICAAS_")]:
-    setattr(sys.modules[__name__], i[6:], os.environ[i])
+    try:
+        value = from_env(getattr(sys.modules[__name__], i[6:], None),
+                         os.environ[i])
+    except ValueError as e:
+        sys.stderr.write('Invalid value for %s. Reason: %s\n' % (i, e))
+        raise SystemExit(1)
+    setattr(sys.modules[__name__], i[6:], value)
 
 # vim: ai ts=4 sts=4 et sw=4 ft=python
@@ -56,10 +56,172 @@ MANIFEST_TIMEOUT = 20
 # The time in minutes to wait for the agent to finish the image creation
 AGENT_TIMEOUT = 60
 
+# The maximum time in minutes a user may allow the agent to run for
+MAX_AGENT_TIMEOUT = 240
+
 # Linear multiplier for the heuristic progress feature
 PROGRESS_HEURISTIC = 6.75
 
 # Interval -in seconds- to report the progress status to the server
 PROGRESS_INTERVAL = 5
 
+# Interval -in seconds- to write the progress reported by an agent to the
+# build. The latest progress is always served by the API.
+PROGRESS_FLUSH_INTERVAL = 60
+
+# Number of builds listed in a page if the user does not specify it
+LIST_DEFAULT_LIMIT = 100
+
+# Maximum number of builds listed in a page
+LIST_MAX_LIMIT = 1000
+
+# Time -in seconds- the watermark returned with the builds that changed lags
+# behind the current time. Changes committed in the meantime are not missed.
+# The build events of this period are also scanned again, since they may
+# commit out of the order of their IDs.
+WATERMARK_LAG = 5
+
+# Maximum time -in seconds- a request may wait for a build to change
+MAX_WAIT = 60
+
+# Interval -in seconds- to check the database while waiting for a build to
+# change. Changes made by other processes are only noticed then.
+WAIT_RECHECK = 2
+
+# Interval -in seconds- to check the database for build events added by
+# other processes, to push them to the clients waiting for changes. Set it to
+# 0 if a single process serves the API.
+EVENT_POLL_INTERVAL = 2
+
+# Interval -in seconds- to send a keep-alive comment to the clients of the
+# build events stream
+STREAM_KEEPALIVE = 15
+
+# Maximum number of build events returned by a single request
+EVENTS_PAGE_SIZE = 500
+
+# Maximum number of builds submitted with a single bulk request
+BULK_MAX_BUILDS = 200
+
+# Maximum number of builds of a user that may run at the same time. The rest
+# are queued and started in turn, round-robin among the users, as the running
+# ones finish. Set it to 0 for no limit.
+MAX_ACTIVE_BUILDS_PER_USER = 20
+
+# Maximum number of builds whose agent VMs are assigned to the same project
+# that may run at the same time. Set it to 0 for no limit.
+MAX_ACTIVE_BUILDS_PER_PROJECT = 50
+
+# Check the Astakos quota of the project an agent VM is assigned to before
+# accepting a build
+CHECK_QUOTA = True
+
+# Resources an agent VM takes up from the quota of its project. Add the cpu,
+# ram and disk of AGENT_IMAGE_FLAVOR_ID to check those as well. As an
+# environment variable, it is given in JSON.
+AGENT_QUOTA = {'cyclades.vm': 1}
+
+# What to do with a build whose agent VM does not fit in the quota: 'reject'
+# it with 409 (Conflict) or 'queue' it until other agents are destroyed
+QUOTA_EXCEEDED = 'reject'
+
+# Maximum number of users whose quotas are cached
+QUOTA_CACHE_SIZE = 10000
+
+# Time in seconds to cache the quotas of a user. The cached usage is updated
+# as the agent VMs are created and destroyed.
+QUOTA_CACHE_TTL = 60
+
+# Number of progress report intervals after which an agent that has stopped
+# reporting back is considered stalled
+AGENT_STALL_INTERVALS = 24
+
+# Maximum number of user tokens to keep in the authentication cache. Set it to
+# 0 to disable the cache.
+TOKEN_CACHE_SIZE = 10000
+
+# Time in seconds to trust a token that was validated by Astakos. A token is
+# never cached after the expiration time Astakos reports for it.
+TOKEN_CACHE_TTL = 300
+
+# Time in seconds to remember a token that was rejected by Astakos
+TOKEN_CACHE_NEGATIVE_TTL = 10
+
+# Time in seconds to wait for a validation of the same token that is already
+# in progress, before asking Astakos directly
+TOKEN_COALESCE_TIMEOUT = 30
+
+# Maximum number of users to keep in the user lookup cache
+USER_CACHE_SIZE = 10000
+
+# Time in seconds to keep a user in the user lookup cache
+USER_CACHE_TTL = 3600
+
+# Number of threads that create ICaaS agent VMs in the background
+CREATE_WORKERS = 4
+
+# Maximum number of agent VM creations waiting for a free thread. Requests
+# that would exceed it are rejected with 503 (Service Unavailable).
+CREATE_QUEUE_SIZE = 200
+
+# Number of threads that destroy ICaaS agent VMs in the background
+DESTROY_WORKERS = 4
+
+# Maximum number of agent VM destructions waiting for a free thread
+DESTROY_QUEUE_SIZE = 1000
+
+# Number of threads delivering the build completion callbacks
+WEBHOOK_WORKERS = 4
+
+# Maximum number of callbacks waiting for a free thread
+WEBHOOK_QUEUE_SIZE = 1000
+
+# Time in seconds to wait for the receiver of a callback to respond
+WEBHOOK_TIMEOUT = 10
+
+# Hosts the callbacks may be sent to even if they resolve to loopback, private
+# or link-local addresses. The callbacks to any other such host are refused,
+# so that users cannot reach the services in the network of ICaaS.
+CALLBACK_ALLOWED_HOSTS = []
+
+# Key used to sign the callbacks with HMAC-SHA256. The signature is sent in
+# the X-Icaas-Signature header. The callbacks are not signed if it is not set.
+WEBHOOK_SECRET = None
+
+# Time in seconds to wait for the queued background tasks on shutdown
+WORKER_SHUTDOWN_TIMEOUT = 30
+
+# Maximum number of times to try an operation on an agent VM
+JOB_MAX_ATTEMPTS = 5
+
+# Time in seconds to wait before retrying a failed agent VM operation. The
+# delay is doubled after each failed attempt.
+JOB_RETRY_DELAY = 10
+
+# Maximum time in seconds to wait before retrying a failed agent VM operation
+JOB_RETRY_MAX_DELAY = 600
+
+# Time in seconds after which an agent VM operation that is still running is
+# considered lost and may be executed again
+JOB_LEASE = 300
+
+# Execute the agent VM operations in the process that served the request. Set
+# this to False if all the operations should be executed by dispatcher
+# processes started with 'icaas-manage dispatcher'.
+DISPATCH_IN_PROCESS = True
+
+# Number of timed out agent VMs the reaper destroys in parallel
+REAPER_WORKERS = 8
+
+# Number of timed out builds the reaper loads from the database at once
+REAPER_CHUNK = 100
+
+# Maximum time in seconds the reaper sleeps before checking for timed out
+# builds
+REAPER_MAX_SLEEP = 60
+
+# Token that needs to be present in the X-Metrics-Token header of the requests
+# to /icaas/metrics. The endpoint is disabled if this is not set.
+METRICS_TOKEN = None
+
 # vim: ai ts=4 sts=4 et sw=4 ft=python
@@ -17,17 +17,38 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from datetime import datetime, timedelta
+import multiprocessing
+import BaseHTTPServer
+import hashlib
+import hmac
 import logging
+import tempfile
 import threading
+import shutil
+import time
+import os
 
 from flask import json
 from flask.ext.testing import TestCase
 from mock import patch, Mock
+from sqlalchemy import event, func, inspect, MetaData, Table
 
 import astakosclient
+from kamaki.clients import ClientError
 
 from icaas import create_app, settings
-from icaas.models import db, Build, User
+from icaas.models import db, Build, BuildEvent, BuildProgress, User, Job
+from icaas.auth import token_cache, user_cache, authenticate
+from icaas.workers import (WorkerPool, create_pool, destroy_pool,
+                           webhook_pool)
+from icaas.reaper import reap, expire_manifests, expire_stalled
+from icaas.schema import upgrade
+from icaas import jobs
+from icaas import notify
+from icaas import utils
+from icaas.quotas import quota_cache
+from icaas import quotas
 
 
 logger = logging.getLogger(__name__)
@@ -74,20 +95,90 @@ def create_test_user():
     return user
 
 
-def create_test_build():
-    """Create a test build to be used on the tests"""
-    user = create_test_user()
+def create_test_build(user=None, **attrs):
+    """Create a test build to be used on the tests. The test user is created
+    if no `user` is given. Keyword arguments override the attributes of the
+    build.
+    """
+    if user is None:
+        user = create_test_user()
 
     build = Build(
         user.id, "Test Image", "Simple Test Image", False,
         "http://example.org/image.diskdump", 0,
         dict(container='image', object='test.diskdump'),
         dict(container='icaas', object='log.txt'))
+    for name, value in attrs.items():
+        setattr(build, name, value)
     db.session.add(build)
     db.session.commit()
     return (user, build)
 
 
+def build_request(**params):
+    """Return the body of a request that creates a build. Keyword arguments
+    override the parameters of the build.
+    """
+    build = dict(name='test', src='http://example.org',
+                 image=dict(container='pithos', object='img'),
+                 log=dict(container='pithos', object='log'))
+    build.update(params)
+    return json.dumps(dict(build=build))
+
+
+class CallbackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Records the build completion callbacks it receives"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.callbacks.append((dict(self.headers), body))
+        self.send_response(self.server.code)
+        if self.server.location:
+            self.send_header('Location', self.server.location)
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.callbacks.append((dict(self.headers), None))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_callback_server(code):
+    """Start an HTTP server that responds to the callbacks with a status
+    code. Set its `location` to redirect them.
+    """
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), CallbackHandler)
+    server.callbacks = []
+    server.code = code
+    server.location = None
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run_dispatcher_process(uri, calls):
+    """Run a job dispatcher against the database found at uri and record the
+    destroyed agent VMs in the calls file
+    """
+    def delete_server(self, server_id):
+        with open(calls, 'a') as f:
+            f.write('%s\n' % server_id)
+
+    # Use a real connection pool instead of the one IcaasTestCase installs
+    del db.apply_driver_hacks
+
+    settings.SQLALCHEMY_DATABASE_URI = uri
+    app = create_app()
+    with patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+               delete_server):
+        with app.app_context():
+            jobs.run_dispatcher(2, 0, exit_when_idle=True)
+
+
 class IcaasTestCase(TestCase):
     """ICaaS unittests class"""
     def create_app(self):
@@ -120,6 +211,11 @@ class IcaasTestCase(TestCase):
         import types
         db.apply_driver_hacks = types.MethodType(sqlite_inmemory_hacks, db)
 
+        # All the tests share a single database connection
+        settings.EVENT_POLL_INTERVAL = 0
+        # Astakos is not available to the tests
+        settings.CHECK_QUOTA = False
+
         app = create_app()
         app.config['TESTING'] = True
         app.config['WTF_CSRF_ENABLED'] = False
@@ -131,9 +227,14 @@ class IcaasTestCase(TestCase):
     def setUp(self):
         """Setup the application's database"""
         db.create_all()
+        token_cache.clear()
+        user_cache.clear()
+        quota_cache.clear()
 
     def tearDown(self):
         """Remove the application's database"""
+        # Builds that finish start the queued ones in the background
+        create_pool.join()
         db.session.remove()
         db.drop_all()
 
@@ -151,6 +252,99 @@ class IcaasTestCase(TestCase):
                              headers=[('X-Auth-Token', 'test')])
         self.assertEquals(rv.status_code, 401)
 
+    def test_token_cache(self):
+        """Test that validated and rejected tokens are cached"""
+        authorized = Mock(return_value=astakos_authorized.return_value)
+        with patch('astakosclient.AstakosClient.authenticate', authorized):
+            for _ in range(3):
+                rv = self.client.get('/icaas/builds',
+                                     headers=[('X-Auth-Token', USER_TOKEN)])
+                self.assertEquals(rv.status_code, 200)
+        self.assertEquals(authorized.call_count, 1)
+
+        unauthorized = Mock(side_effect=astakos_unauthorized.side_effect)
+        with patch('astakosclient.AstakosClient.authenticate', unauthorized):
+            for _ in range(3):
+                rv = self.client.get('/icaas/builds',
+                                     headers=[('X-Auth-Token', 'invalid')])
+                self.assertEquals(rv.status_code, 401)
+        self.assertEquals(unauthorized.call_count, 1)
+
+        stats = token_cache.stats()
+        self.assertEquals(stats['size'], 2)
+        self.assertEquals(stats['hits'], 4)
+        self.assertEquals(stats['misses'], 2)
+
+    def test_token_coalescing(self):
+        """Test that concurrent validations of a token are coalesced"""
+        gate = threading.Event()
+
+        def slow_authenticate():
+            gate.wait(5)
+            return astakos_authorized.return_value
+
+        authorized = Mock(side_effect=slow_authenticate)
+        results = []
+
+        def worker():
+            results.append(authenticate(USER_TOKEN))
+
+        with patch('astakosclient.AstakosClient.authenticate', authorized):
+            threads = [threading.Thread(target=worker) for _ in range(5)]
+            for t in threads:
+                t.start()
+            time.sleep(0.2)
+            gate.set()
+            for t in threads:
+                t.join()
+
+        self.assertEquals(authorized.call_count, 1)
+        self.assertEquals(results, [USER_ID] * 5)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_user_cache(self):
+        """Test that known users are not looked up in the database"""
+        rv = self.client.get('/icaas/builds',
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 200)
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if 'FROM user' in statement or 'UPDATE user' in statement:
+                statements.append(statement)
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            rv = self.client.get('/icaas/builds',
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+            self.assertEquals(rv.status_code, 200)
+            self.assertEquals(statements, [])
+
+            # A new token for the same user should update the database
+            rv = self.client.get('/icaas/builds',
+                                 headers=[('X-Auth-Token', 'new-token')])
+            self.assertEquals(rv.status_code, 200)
+            self.assertEquals(len(statements), 2)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+        users = User.query.all()
+        self.assertEquals(len(users), 1)
+        self.assertEquals(users[0].token, 'new-token')
+
+    @patch('astakosclient.AstakosClient.authenticate', Mock(return_value={
+        u'access': {
+            u'token': {u'expires': u'2015-09-13T09:18:29.988089+00:00'},
+            u'user': {u'id': USER_ID}}}))
+    def test_token_cache_expired(self):
+        """Test that tokens are not cached past their expiration time"""
+        rv = self.client.get('/icaas/builds',
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(token_cache.stats()['size'], 0)
+
     @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
     @patch('kamaki.clients.cyclades.CycladesComputeClient.create_server',
            kamaki_create_server)
@@ -169,10 +363,8 @@ class IcaasTestCase(TestCase):
                               data=json.dumps(data),
                               content_type='application/json')
 
-        # Wait for the agent creation thread to finish
-        for t in threading.enumerate():
-            if t.name.startswith('CreateAgentThread'):
-                t.join()
+        # Wait for the agent creation task to finish
+        create_pool.join()
 
         self.assertEquals(json.loads(rv.data)['build']['id'], 1)
         builds = Build.query.all()
@@ -184,6 +376,1220 @@ class IcaasTestCase(TestCase):
         self.assertEquals(json.loads(build.image), image)
         self.assertEquals(json.loads(build.log), log)
 
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.create_server',
+           kamaki_create_server)
+    def test_bulk_create(self):
+        """Test creating many images at once"""
+        def build(name):
+            return {'name': name,
+                    'src': 'http://example.org/image.diskdump',
+                    'image': {'container': 'image', 'object': name},
+                    'log': {'container': 'icaas', 'object': 'log.txt'}}
+        invalid = build('invalid')
+        del invalid['src']
+        data = {'builds': [build('one'), invalid, build('two'),
+                           dict(build('three'), project='proj')]}
+
+        rv = self.client.post('/icaas/builds/bulk', data=json.dumps(data),
+                              headers=[('X-Auth-Token', USER_TOKEN)],
+                              content_type='application/json')
+        create_pool.join()
+        self.assertEquals(rv.status_code, 202)
+        results = json.loads(rv.data)['builds']
+        self.assertEquals(len(results), 4)
+        self.assertEquals(results[1]['error']['status'], 400)
+        self.assertEquals([r['build']['name'] for r in results[::2]],
+                          ['one', 'two'])
+        self.assertEquals(results[2]['build']['status'], 'CREATING')
+
+        builds = Build.query.order_by(Build.id).all()
+        self.assertEquals([b.name for b in builds], ['one', 'two', 'three'])
+        self.assertEquals([r['build']['id'] for r in results
+                           if 'build' in r], [b.id for b in builds])
+        for b in builds:
+            self.assertEquals(b.agent, VM_ID)
+            self.assertEquals(b.description, '')
+            self.assertEquals(BuildEvent.query.filter_by(build=b.id).count(),
+                              2)
+        job = Job.query.filter_by(build=builds[2].id).one()
+        self.assertEquals(job.state, 'DONE')
+        self.assertEquals(json.loads(job.params)['project'], 'proj')
+
+        for data in ({'builds': []}, {'builds': [invalid]},
+                     {'builds': [build('x')] *
+                      (int(settings.BULK_MAX_BUILDS) + 1)}):
+            rv = self.client.post('/icaas/builds/bulk', data=json.dumps(data),
+                                  headers=[('X-Auth-Token', USER_TOKEN)],
+                                  content_type='application/json')
+            self.assertEquals(rv.status_code, 400)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.create_server',
+           kamaki_create_server)
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    @patch.object(settings, 'MAX_ACTIVE_BUILDS_PER_USER', 1)
+    def test_queued_build(self):
+        """Test that builds over the limit wait for the running ones"""
+        for i in range(2):
+            rv = self.client.post('/icaas/builds', data=build_request(),
+                                  headers=[('X-Auth-Token', USER_TOKEN)],
+                                  content_type='application/json')
+            self.assertEquals(rv.status_code, 202)
+            create_pool.join()
+
+        first, second = Build.query.order_by(Build.id).all()
+        self.assertEquals(first.status, 'CREATING')
+        self.assertEquals(second.status, 'QUEUED')
+        self.assertIsNone(second.agent)
+        self.assertEquals(Job.query.filter_by(build=second.id).one().state,
+                          'WAITING')
+
+        # The agent of the queued build gets all of its time once it starts
+        second.created -= timedelta(hours=1)
+        second.agent_deadline -= timedelta(hours=1)
+        db.session.commit()
+
+        # Run the jobs one after the other, they share the test connection
+        with patch.object(settings, 'DISPATCH_IN_PROCESS', False):
+            rv = self.client.put('/icaas/builds/agent/%d' % first.id,
+                                 headers=[('X-Icaas-Token', first.token)],
+                                 data=json.dumps({'status': 'COMPLETED'}),
+                                 content_type='application/json')
+            self.assertEquals(rv.status_code, 204)
+            self.assertEquals(jobs.run_pending(10), 1)
+            self.assertEquals(jobs.promote(), 1)
+            self.assertEquals(jobs.run_pending(10), 1)
+
+        second = Build.query.get(second.id)
+        self.assertEquals(second.status, 'CREATING')
+        self.assertEquals(second.agent, VM_ID)
+        self.assertTrue(second.agent_deadline > datetime.utcnow() +
+                        timedelta(minutes=int(settings.AGENT_TIMEOUT) - 1))
+        self.assertTrue(second.manifest_deadline > datetime.utcnow())
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.create_server',
+           kamaki_create_server)
+    @patch.object(settings, 'MAX_ACTIVE_BUILDS_PER_USER', 1)
+    def test_cancel_queued_build(self):
+        """Test that canceled or deleted queued builds leave no jobs behind"""
+        auth = ('X-Auth-Token', USER_TOKEN)
+        for i in range(4):
+            rv = self.client.post('/icaas/builds', data=build_request(),
+                                  headers=[auth],
+                                  content_type='application/json')
+            self.assertEquals(rv.status_code, 202)
+            create_pool.join()
+        ids = [b.id for b in Build.query.order_by(Build.id)]
+
+        with patch.object(settings, 'DISPATCH_IN_PROCESS', False):
+            rv = self.client.put('/icaas/builds/%d' % ids[1],
+                                 data=json.dumps({'action': 'cancel'}),
+                                 headers=[auth],
+                                 content_type='application/json')
+            self.assertEquals(rv.status_code, 204)
+            rv = self.client.delete('/icaas/builds/%d' % ids[2],
+                                    headers=[auth])
+            self.assertEquals(rv.status_code, 204)
+            rv = self.client.put('/icaas/builds',
+                                 data=json.dumps({'action': 'cancel',
+                                                  'ids': [ids[3]]}),
+                                 headers=[auth],
+                                 content_type='application/json')
+            self.assertEquals(rv.status_code, 200)
+
+        self.assertEquals(Build.query.get(ids[1]).status, 'CANCELED')
+        self.assertTrue(Build.query.get(ids[2]).deleted)
+        self.assertEquals(Build.query.get(ids[3]).status, 'CANCELED')
+        # Their creation was given up and there is no agent to destroy
+        for buildid in ids[1:]:
+            self.assertEquals([(j.action, j.state) for j in
+                               Job.query.filter_by(build=buildid)],
+                              [('CREATE', 'DONE')])
+
+    @patch.object(settings, 'DISPATCH_IN_PROCESS', False)
+    @patch.object(settings, 'MAX_ACTIVE_BUILDS_PER_USER', 2)
+    def test_promote(self):
+        """Test that the users take turns starting their queued builds"""
+        users = [create_test_user(), User('other-user')]
+        db.session.add(users[1])
+        db.session.commit()
+        now = datetime.utcnow()
+        builds = []
+        for i, user in enumerate([users[0]] * 3 + [users[1]]):
+            _, b = create_test_build(user, name="Image %d" % i, agent=None,
+                                     status='QUEUED', project='project',
+                                     created=now + timedelta(seconds=i))
+            job = jobs.enqueue(b, 'CREATE')
+            job.state = 'WAITING'
+            builds.append(b)
+        db.session.commit()
+        ids = [b.id for b in builds]
+
+        def started():
+            return [b.id for b in Build.query.filter_by(status='CREATING')
+                    .order_by(Build.id)]
+
+        with patch.object(settings, 'MAX_ACTIVE_BUILDS_PER_PROJECT', 2):
+            self.assertEquals(jobs.promote(), 2)
+        self.assertEquals(started(), [ids[0], ids[3]])
+        self.assertEquals(
+            sorted(j.build for j in Job.query.filter_by(state='PENDING')),
+            [ids[0], ids[3]])
+
+        self.assertEquals(jobs.promote(), 1)
+        self.assertEquals(started(), [ids[0], ids[1], ids[3]])
+        self.assertEquals(jobs.promote(), 0)
+        self.assertEquals(Build.query.get(ids[2]).status, 'QUEUED')
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.create_server',
+           kamaki_create_server)
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    @patch.object(settings, 'CHECK_QUOTA', True)
+    def test_quota(self):
+        """Test that builds whose agent does not fit in the quota wait"""
+        get_quotas = Mock(return_value={
+            USER_ID: {'cyclades.vm': {'limit': 2, 'usage': 1, 'pending': 0}}})
+
+        def create():
+            rv = self.client.post('/icaas/builds', data=build_request(),
+                                  headers=[('X-Auth-Token', USER_TOKEN)],
+                                  content_type='application/json')
+            create_pool.join()
+            return rv.status_code
+
+        with patch('astakosclient.AstakosClient.get_quotas', get_quotas):
+            self.assertEquals(create(), 202)
+            self.assertEquals(create(), 409)
+            with patch.object(settings, 'QUOTA_EXCEEDED', 'queue'):
+                self.assertEquals(create(), 202)
+            self.assertEquals(get_quotas.call_count, 1)
+
+            first, second = Build.query.order_by(Build.id).all()
+            self.assertEquals(first.status, 'CREATING')
+            self.assertEquals(second.status, 'QUEUED')
+
+            # Completing the build does not make room until its agent is
+            # destroyed. The jobs run one after the other, they share the
+            # test connection.
+            with patch.object(settings, 'DISPATCH_IN_PROCESS', False):
+                rv = self.client.put(
+                    '/icaas/builds/agent/%d' % first.id,
+                    headers=[('X-Icaas-Token', first.token)],
+                    data=json.dumps({'status': 'COMPLETED'}),
+                    content_type='application/json')
+                self.assertEquals(rv.status_code, 204)
+                self.assertEquals(jobs.promote(), 0)
+                self.assertEquals(jobs.run_pending(10), 1)
+                self.assertEquals(jobs.promote(), 1)
+                self.assertEquals(jobs.run_pending(10), 1)
+            self.assertEquals(get_quotas.call_count, 1)
+
+        second = Build.query.get(second.id)
+        self.assertEquals(second.status, 'CREATING')
+        self.assertEquals(second.agent, VM_ID)
+
+    @patch.object(settings, 'CHECK_QUOTA', True)
+    @patch.object(settings, 'DISPATCH_IN_PROCESS', False)
+    def test_quota_outside_lock(self):
+        """Test that Astakos is not asked while the queue is locked"""
+        user, build = create_test_build()
+        build.status = 'QUEUED'
+        db.session.commit()
+        get_quotas = Mock(return_value={
+            USER_ID: {'cyclades.vm': {'limit': 5, 'usage': 0, 'pending': 0}}})
+        locked = []
+        lock = Mock(side_effect=lambda: locked.append(get_quotas.call_count))
+
+        with patch('astakosclient.AstakosClient.get_quotas', get_quotas), \
+                patch.object(jobs, 'lock_queue', lock):
+            self.assertEquals(jobs.admit(user, [None]), ['QUEUED'])
+            db.session.rollback()
+            quota_cache.clear()
+            self.assertEquals(jobs.promote(), 1)
+
+        self.assertEquals(locked, [1, 2])
+        self.assertEquals(get_quotas.call_count, 2)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch.object(settings, 'CHECK_QUOTA', True)
+    @patch.object(settings, 'DISPATCH_IN_PROCESS', False)
+    def test_quota_canceled(self):
+        """Test that builds canceled before their agent exists give back the
+        quota they were charged
+        """
+        get_quotas = Mock(return_value={
+            USER_ID: {'cyclades.vm': {'limit': 1, 'usage': 0, 'pending': 0}}})
+        auth = ('X-Auth-Token', USER_TOKEN)
+        with patch('astakosclient.AstakosClient.get_quotas', get_quotas):
+            rv = self.client.post('/icaas/builds', data=build_request(),
+                                  headers=[auth],
+                                  content_type='application/json')
+            self.assertEquals(rv.status_code, 202)
+            build = Build.query.one()
+            user = User.query.get(build.user)
+            self.assertEquals(quotas.room(user, None), 0)
+
+            rv = self.client.put('/icaas/builds/%d' % build.id,
+                                 data=json.dumps({'action': 'cancel'}),
+                                 headers=[auth],
+                                 content_type='application/json')
+            self.assertEquals(rv.status_code, 204)
+            for job in Job.query.order_by(Job.id).all():
+                self.assertTrue(jobs.run_job(job.id))
+            self.assertIsNone(Build.query.get(build.id).agent)
+            self.assertEquals(quotas.room(user, None), 1)
+
+    @patch.object(settings, 'CHECK_QUOTA', True)
+    def test_quota_project(self):
+        """Test that the quota left on the whole project is respected"""
+        user = create_test_user()
+        vm = {'limit': 5, 'usage': 0, 'pending': 0,
+              'project_limit': 10, 'project_usage': 8, 'project_pending': 1}
+        get_quotas = Mock(return_value={USER_ID: {'cyclades.vm': vm}})
+        with patch('astakosclient.AstakosClient.get_quotas', get_quotas):
+            self.assertEquals(quotas.room(user, None), 1)
+            quotas.charge(user, None, 1)
+            self.assertEquals(quotas.room(user, None), 0)
+            quotas.charge(user, None, -1)
+            vm['project_limit'] = 100
+            self.assertEquals(quotas.room(user, None), 5)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_create_image_busy(self):
+        """Test that builds are rejected when the agent queue is full"""
+
+        with patch.object(create_pool, 'full', Mock(return_value=True)):
+            rv = self.client.post('/icaas/builds',
+                                  headers=[('X-Auth-Token', USER_TOKEN)],
+                                  data=build_request(),
+                                  content_type='application/json')
+
+        self.assertEquals(rv.status_code, 503)
+        self.assertEquals(Build.query.count(), 0)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_create_image_callback(self):
+        """Test that invalid callback URLs are rejected"""
+        for callback in ('ftp://example.org', 'example.org', 42,
+                         'http://127.0.0.1:8080/', 'http://localhost/',
+                         'http://169.254.169.254/latest/meta-data',
+                         'http://10.0.0.1/', 'http://[::1]/',
+                         'http://[::ffff:192.168.1.1]/'):
+            rv = self.client.post('/icaas/builds',
+                                  headers=[('X-Auth-Token', USER_TOKEN)],
+                                  data=build_request(callback=callback),
+                                  content_type='application/json')
+            self.assertEquals(rv.status_code, 400)
+        self.assertEquals(Build.query.count(), 0)
+
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    @patch.object(settings, 'WEBHOOK_SECRET', 'secret')
+    @patch.object(settings, 'CALLBACK_ALLOWED_HOSTS', ['127.0.0.1'])
+    def test_callback(self):
+        """Test delivering the build completion callbacks"""
+        server = start_callback_server(200)
+        try:
+            user, build = create_test_build()
+            build.callback = 'http://127.0.0.1:%d/done' % server.server_port
+            db.session.commit()
+
+            rv = self.client.put('/icaas/builds/agent/%d' % build.id,
+                                 headers=[('X-Icaas-Token', build.token)],
+                                 data=json.dumps({'status': 'COMPLETED'}),
+                                 content_type='application/json')
+            self.assertEquals(rv.status_code, 204)
+            webhook_pool.join()
+            destroy_pool.join()
+        finally:
+            server.shutdown()
+
+        self.assertEquals(len(server.callbacks), 1)
+        headers, body = server.callbacks[0]
+        self.assertEquals(json.loads(body)['build']['status'], 'COMPLETED')
+        signature = hmac.new('secret', body, hashlib.sha256).hexdigest()
+        self.assertEquals(headers['x-icaas-signature'],
+                          'sha256=%s' % signature)
+        job = Job.query.filter_by(action='NOTIFY').one()
+        self.assertEquals(job.state, 'DONE')
+
+    @patch.object(settings, 'CALLBACK_ALLOWED_HOSTS', ['127.0.0.1'])
+    def test_callback_redirect(self):
+        """Test that the redirects of the callback receivers are refused"""
+        server = start_callback_server(302)
+        server.location = 'http://127.0.0.1:%d/latest/meta-data' % \
+            server.server_port
+        try:
+            user, build = create_test_build()
+            build.callback = 'http://127.0.0.1:%d/done' % server.server_port
+            build.status = 'ERROR'
+            with patch.object(settings, 'DISPATCH_IN_PROCESS', False):
+                db.session.commit()
+            jobid = Job.query.filter_by(action='NOTIFY').one().id
+            self.assertTrue(jobs.run_job(jobid))
+        finally:
+            server.shutdown()
+
+        # Only the callback itself was sent
+        self.assertEquals(len(server.callbacks), 1)
+        self.assertIsNotNone(server.callbacks[0][1])
+        job = Job.query.get(jobid)
+        self.assertEquals(job.state, 'FAILED')
+        self.assertIn('302', job.last_error)
+
+    def test_callback_private_address(self):
+        """Test that callbacks are not sent to private addresses"""
+        for address in ('127.0.0.1', '10.1.2.3', '172.31.0.1', '192.168.0.1',
+                        '169.254.169.254', '100.64.0.1', '0.0.0.0',
+                        '224.0.0.1', '255.255.255.255', '::', '::1',
+                        'fe80::1', 'fe80::1%eth0', 'fd00::1',
+                        '::ffff:127.0.0.1'):
+            self.assertTrue(utils.is_private_address(address), address)
+        for address in ('8.8.8.8', '172.32.0.1', '2001:db8::1',
+                        '::ffff:8.8.8.8'):
+            self.assertFalse(utils.is_private_address(address), address)
+
+        user, build = create_test_build()
+        build.callback = 'http://127.0.0.1:1/done'
+        build.status = 'ERROR'
+        with patch.object(settings, 'DISPATCH_IN_PROCESS', False):
+            db.session.commit()
+        jobid = Job.query.filter_by(action='NOTIFY').one().id
+        self.assertTrue(jobs.run_job(jobid))
+        job = Job.query.get(jobid)
+        self.assertEquals(job.state, 'FAILED')
+        self.assertIn('not allowed', job.last_error)
+
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    @patch.object(settings, 'CALLBACK_ALLOWED_HOSTS', ['127.0.0.1'])
+    def test_callback_retry(self):
+        """Test that failed callbacks are retried"""
+        server = start_callback_server(503)
+        try:
+            user, build = create_test_build()
+            build.callback = 'http://127.0.0.1:%d/done' % server.server_port
+            build.status = 'ERROR'
+            with patch.object(settings, 'DISPATCH_IN_PROCESS', False):
+                db.session.commit()
+            jobid = Job.query.filter_by(action='NOTIFY').one().id
+            self.assertTrue(jobs.run_job(jobid))
+        finally:
+            server.shutdown()
+
+        self.assertEquals(len(server.callbacks), 1)
+        self.assertNotIn('x-icaas-signature', server.callbacks[0][0])
+        job = Job.query.get(jobid)
+        self.assertEquals(job.state, 'PENDING')
+        self.assertEquals(job.attempts, 1)
+        self.assertIn('503', job.last_error)
+
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.list_servers',
+           Mock(return_value=[]))
+    def test_job_retry(self):
+        """Test that failed agent creations are retried"""
+        user, build = create_test_build()
+        build.agent = None
+        job = jobs.enqueue(build, 'CREATE')
+        db.session.commit()
+        jobid = job.id
+
+        failure = Mock(side_effect=ClientError('Service Unavailable', 503))
+        with patch('kamaki.clients.cyclades.CycladesComputeClient.'
+                   'create_server', failure):
+            self.assertTrue(jobs.run_job(jobid))
+            # The job should not be retried before the backoff expires
+            self.assertFalse(jobs.run_job(jobid))
+
+        job = Job.query.get(jobid)
+        self.assertEquals(job.state, 'PENDING')
+        self.assertEquals(job.attempts, 1)
+        self.assertTrue(job.next_attempt > datetime.utcnow())
+        self.assertEquals(Build.query.get(build.id).status, 'CREATING')
+
+        job.next_attempt = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+        with patch('kamaki.clients.cyclades.CycladesComputeClient.'
+                   'create_server', kamaki_create_server):
+            self.assertEquals(jobs.run_pending(10), 1)
+
+        job = Job.query.get(jobid)
+        self.assertEquals(job.state, 'DONE')
+        self.assertEquals(job.attempts, 2)
+        build = Build.query.get(build.id)
+        self.assertEquals(build.agent, VM_ID)
+        self.assertTrue(build.agent_alive)
+
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    @patch.object(settings, 'DISPATCH_IN_PROCESS', False)
+    def test_cancel_during_creation(self):
+        """Test that an agent created for a canceled build is destroyed"""
+        user, build = create_test_build()
+        build.agent = None
+        build.agent_alive = False
+        job = jobs.enqueue(build, 'CREATE')
+        db.session.commit()
+        buildid, jobid = build.id, job.id
+
+        def create_server(*args, **kwargs):
+            # The user cancels the build while its agent is being created
+            db.session.execute(Build.__table__.update()
+                               .where(Build.id == buildid)
+                               .values(status='CANCELED'))
+            return {u'id': VM_ID}
+
+        with patch('kamaki.clients.cyclades.CycladesComputeClient.'
+                   'create_server', Mock(side_effect=create_server)):
+            self.assertTrue(jobs.run_job(jobid))
+
+        build = Build.query.get(buildid)
+        self.assertEquals(build.status, 'CANCELED')
+        self.assertEquals(build.agent, VM_ID)
+        destroy = Job.query.filter_by(build=buildid, action='DESTROY').one()
+        self.assertEquals(destroy.state, 'PENDING')
+
+        self.assertEquals(jobs.run_pending(10), 1)
+        self.assertFalse(Build.query.get(buildid).agent_alive)
+
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.create_server',
+           Mock(side_effect=ClientError('Over Limit', 413)))
+    def test_job_permanent_failure(self):
+        """Test that client errors are not retried"""
+        user, build = create_test_build()
+        build.agent = None
+        job = jobs.enqueue(build, 'CREATE')
+        db.session.commit()
+
+        self.assertTrue(jobs.run_job(job.id))
+
+        job = Job.query.get(job.id)
+        self.assertEquals(job.state, 'FAILED')
+        self.assertEquals(job.attempts, 1)
+        self.assertEquals(Build.query.get(build.id).status, 'ERROR')
+
+    def test_settings_from_env(self):
+        """Test converting the settings given as environment variables"""
+        for value in ('1', 'True', 'yes', ' on '):
+            self.assertTrue(settings.from_env(False, value))
+        for value in ('0', 'False', 'no', ''):
+            self.assertFalse(settings.from_env(True, value))
+        self.assertEquals(settings.from_env(10, '20'), '20')
+        self.assertEquals(settings.from_env({}, '{"cyclades.vm": 2}'),
+                          {'cyclades.vm': 2})
+
+    def test_pool_shutdown_timeout(self):
+        """Test that a pool with a full queue is not waited for forever"""
+        release = threading.Event()
+        pool = WorkerPool('TestShutdown', 1, 1)
+        pool.submit(release.wait)
+        while pool.stats()['active'] == 0:
+            time.sleep(0.01)
+        pool.submit(release.wait)
+
+        start = time.time()
+        pool.shutdown(0.2)
+        self.assertTrue(time.time() - start < 2)
+        release.set()
+
+    def test_dispatcher_processes(self):
+        """Test that dispatcher processes never execute a job twice"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            uri = 'sqlite:///%s' % os.path.join(tmpdir, 'icaas.db')
+            calls = os.path.join(tmpdir, 'calls')
+
+            with patch.object(settings, 'SQLALCHEMY_DATABASE_URI', uri):
+                app = create_app()
+
+            with app.app_context():
+                db.create_all()
+                user, _ = create_test_build()
+                for i in range(40):
+                    _, build = create_test_build(user, agent='vm-%d' % i,
+                                                 agent_alive=True)
+                    jobs.enqueue(build, 'DESTROY')
+                db.session.commit()
+                db.session.remove()
+
+            processes = [multiprocessing.Process(target=run_dispatcher_process,
+                                                 args=(uri, calls))
+                         for _ in range(4)]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join(60)
+                self.assertEquals(p.exitcode, 0)
+
+            with open(calls) as f:
+                destroyed = f.read().split()
+            self.assertEquals(sorted(destroyed),
+                              sorted('vm-%d' % i for i in range(40)))
+
+            with app.app_context():
+                states = set((j.state, j.attempts) for j in Job.query.all())
+                self.assertEquals(states, set([('DONE', 1)]))
+                self.assertEquals(Build.query.filter_by(
+                                  agent_alive=True).count(), 0)
+                db.session.remove()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    def test_reaper(self):
+        """Test that the reaper destroys the agents of timed out builds"""
+        user, build = create_test_build()
+        build.agent_alive = True
+        for i in range(5):
+            create_test_build(user, agent='vm-%d' % i, agent_alive=True,
+                              agent_deadline=datetime.utcnow() -
+                              timedelta(minutes=1))
+        db.session.commit()
+
+        pool = WorkerPool('TestReaper', 1, 2)
+        try:
+            self.assertEquals(reap(2, pool), 5)
+            # Nothing should be left to reap
+            self.assertEquals(reap(2, pool), 0)
+        finally:
+            pool.shutdown()
+
+        self.assertEquals(Build.query.filter_by(agent_alive=True).count(), 1)
+        self.assertEquals(Build.query.filter_by(status='ERROR').count(), 5)
+        self.assertTrue(Build.query.get(build.id).is_active())
+        self.assertEquals(Job.query.filter_by(state='DONE').count(), 5)
+
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    def test_expire_manifests(self):
+        """Test that builds whose agent never started up are reaped"""
+        user, booted = create_test_build()
+        booted.nonce_invalid = True
+        stuck = []
+        for i in range(3):
+            _, b = create_test_build(user, agent='vm-%d' % i,
+                                     agent_alive=True,
+                                     manifest_deadline=datetime.utcnow() -
+                                     timedelta(minutes=1))
+            stuck.append(b)
+        booted.manifest_deadline = datetime.utcnow() - timedelta(minutes=1)
+        booted.agent_alive = True
+        db.session.commit()
+        stuck = [b.id for b in stuck]
+
+        pool = WorkerPool('TestReaper', 1, 2)
+        try:
+            self.assertEquals(expire_manifests(2, pool), 3)
+            self.assertEquals(expire_manifests(2, pool), 0)
+        finally:
+            pool.shutdown()
+
+        for build in Build.query.filter(Build.id.in_(stuck)):
+            self.assertEquals(build.status, 'ERROR')
+            self.assertTrue(build.nonce_invalid)
+            self.assertFalse(build.agent_alive)
+        booted = Build.query.get(booted.id)
+        self.assertTrue(booted.is_active())
+        self.assertTrue(booted.agent_alive)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    def test_agent_progress(self):
+        """Test that progress reports are written to the build in batches"""
+        user, build = create_test_build()
+        rv = self.client.get('/icaas/builds/agent/%d/%s' %
+                             (build.id, build.nonce))
+        self.assertEquals(rv.status_code, 200)
+
+        def report(status, current):
+            rv = self.client.put(
+                '/icaas/builds/agent/%d' % build.id,
+                headers=[('X-Icaas-Token', build.token)],
+                data=json.dumps({'status': status,
+                                 'agent-progress': {'current': current,
+                                                    'total': 10}}),
+                content_type='application/json')
+            self.assertEquals(rv.status_code, 204)
+
+        def progress():
+            rv = self.client.get('/icaas/builds/%d' % build.id,
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+            details = json.loads(rv.data)['build']['status_details']
+            return json.loads(details)['agent-progress']['current']
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if 'UPDATE build ' in statement:
+                statements.append(statement)
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            for i in range(1, 4):
+                report('CREATING', i)
+            self.assertEquals(statements, [])
+            self.assertEquals(progress(), 3)
+
+            with patch.object(settings, 'DISPATCH_IN_PROCESS', False):
+                report('COMPLETED', 10)
+            self.assertEquals(len(statements), 1)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+        build = Build.query.get(build.id)
+        self.assertEquals(build.status, 'COMPLETED')
+        details = json.loads(build.status_details)
+        self.assertEquals(details['agent-progress']['current'], 10)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    def test_agent_progress_flush(self):
+        """Test that a status change keeps the progress not yet written"""
+        user, build = create_test_build()
+        rv = self.client.get('/icaas/builds/agent/%d/%s' %
+                             (build.id, build.nonce))
+        self.assertEquals(rv.status_code, 200)
+
+        def report(params):
+            rv = self.client.put(
+                '/icaas/builds/agent/%d' % build.id,
+                headers=[('X-Icaas-Token', build.token)],
+                data=json.dumps(params), content_type='application/json')
+            self.assertEquals(rv.status_code, 204)
+
+        with patch.object(settings, 'DISPATCH_IN_PROCESS', False):
+            for current in (1, 7):
+                report({'status': 'CREATING',
+                        'agent-progress': {'current': current, 'total': 10}})
+            report({'status': 'ERROR'})
+
+        build = Build.query.get(build.id)
+        self.assertEquals(build.status, 'ERROR')
+        details = json.loads(build.status_details)
+        self.assertEquals(details['agent-progress'],
+                          {'current': 7, 'total': 10})
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_list_builds_pages(self):
+        """Test paging through the builds of a user"""
+        user = create_test_user()
+        now = datetime.utcnow()
+        for i in range(5):
+            # Two builds share the same creation time
+            create_test_build(user, name="Image %d" % i,
+                              created=now + timedelta(seconds=min(i, 3)))
+
+        def pages(query):
+            ids = []
+            url = '/icaas/builds?%s' % query
+            while url:
+                rv = self.client.get(url,
+                                     headers=[('X-Auth-Token', USER_TOKEN)])
+                self.assertEquals(rv.status_code, 200)
+                data = json.loads(rv.data)
+                self.assertTrue(len(data['builds']) <= 2)
+                ids.extend(b['id'] for b in data['builds'])
+                url = data.get('links', [{}])[0].get('href')
+                if url:
+                    url = url.replace(settings.ENDPOINT, '/icaas')
+            return ids
+
+        self.assertEquals(pages('limit=2'), [1, 2, 3, 4, 5])
+        self.assertEquals(pages('limit=2&order=desc&details=1'),
+                          [5, 4, 3, 2, 1])
+        self.assertEquals(pages('limit=2&sort=name&order=desc'),
+                          [5, 4, 3, 2, 1])
+
+        for query in ('limit=0', 'limit=foo', 'marker=42', 'sort=src',
+                      'order=up'):
+            rv = self.client.get('/icaas/builds?%s' % query,
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+            self.assertEquals(rv.status_code, 400)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_list_builds_fields(self):
+        """Test listing only some attributes of the builds"""
+        user, build = create_test_build()
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if 'FROM build ' in statement:
+                statements.append(statement)
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            rv = self.client.get('/icaas/builds?fields=status,updated',
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        self.assertEquals(rv.status_code, 200)
+        builds = json.loads(rv.data)['builds']
+        self.assertEquals(len(builds), 1)
+        self.assertEquals(sorted(builds[0].keys()),
+                          ['id', 'status', 'updated'])
+        self.assertEquals(builds[0]['status'], 'CREATING')
+        for statement in statements:
+            self.assertNotIn('status_details', statement)
+            self.assertNotIn('build.log', statement)
+
+        rv = self.client.get('/icaas/builds?fields=image,links',
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 200)
+        builds = json.loads(rv.data)['builds']
+        self.assertEquals(builds[0]['image'],
+                          {'container': 'image', 'object': 'test.diskdump'})
+        self.assertIn('links', builds[0])
+
+        for fields in ('', 'status,token', 'nonce'):
+            rv = self.client.get('/icaas/builds?fields=%s' % fields,
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+            self.assertEquals(rv.status_code, 400)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_list_builds_by_id(self):
+        """Test fetching many builds by their IDs at once"""
+        user, build = create_test_build()
+        _, other = create_test_build(user, name="Other Image")
+        _, deleted = create_test_build(user, name="Deleted Image",
+                                       deleted=True)
+        ids = [other.id, 42, build.id, deleted.id, other.id]
+
+        rv = self.client.get('/icaas/builds?details=1&id=%s' %
+                             ','.join(str(i) for i in ids),
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 200)
+        data = json.loads(rv.data)
+        self.assertEquals([b['id'] for b in data['builds']],
+                          [other.id, build.id])
+        self.assertEquals(data['builds'][1]['status'], 'CREATING')
+        self.assertEquals(data['missing'], [42, deleted.id])
+
+        for query in ('id=', 'id=1,foo', 'id=%s' % ','.join(
+                str(i) for i in range(int(settings.LIST_MAX_LIMIT) + 1))):
+            rv = self.client.get('/icaas/builds?%s' % query,
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+            self.assertEquals(rv.status_code, 400)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch.object(settings, 'WATERMARK_LAG', 0)
+    def test_list_changed_builds(self):
+        """Test listing the builds that changed since the last time"""
+        user = create_test_user()
+        past = datetime.utcnow() - timedelta(hours=1)
+        for i in range(3):
+            create_test_build(user, name="Image %d" % i, updated=past)
+
+        rv = self.client.get('/icaas/builds?changed_since=%s' %
+                             (past - timedelta(seconds=1)).isoformat(),
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 200)
+        data = json.loads(rv.data)
+        self.assertEquals(len(data['builds']), 3)
+        self.assertEquals(data['deleted'], [])
+
+        time.sleep(0.01)
+        Build.query.get(1).name = 'renamed'
+        Build.query.get(2).deleted = True
+        db.session.commit()
+
+        rv = self.client.get('/icaas/builds?details=1&changed_since=%s' %
+                             data['watermark'],
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 200)
+        data = json.loads(rv.data)
+        self.assertEquals([b['name'] for b in data['builds']], ['renamed'])
+        self.assertEquals([b['id'] for b in data['deleted']], [2])
+
+        rv = self.client.get('/icaas/builds?changed_since=%s' %
+                             data['watermark'],
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        data = json.loads(rv.data)
+        self.assertEquals(data['builds'], [])
+
+        rv = self.client.get('/icaas/builds?changed_since=yesterday',
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 400)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    @patch.object(settings, 'WAIT_RECHECK', 30)
+    def test_view_wait(self):
+        """Test waiting for a build to change"""
+        user, build = create_test_build()
+        url = '/icaas/builds/%d' % build.id
+        token = build.token
+
+        start = time.time()
+        rv = self.client.get('%s?wait=0.2' % url,
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 200)
+        self.assertTrue(time.time() - start >= 0.2)
+        updated = json.loads(rv.data)['build']['updated']
+
+        def complete():
+            time.sleep(0.2)
+            self.client.put('/icaas/builds/agent/%d' % build.id,
+                            headers=[('X-Icaas-Token', token)],
+                            data=json.dumps({'status': 'COMPLETED'}),
+                            content_type='application/json')
+
+        thread = threading.Thread(target=complete)
+        thread.start()
+        start = time.time()
+        rv = self.client.get('%s?wait=20&since=%s' % (url, updated),
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        thread.join()
+        destroy_pool.join()
+        self.assertEquals(rv.status_code, 200)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEquals(json.loads(rv.data)['build']['status'], 'COMPLETED')
+
+        # Finished builds are returned at once
+        start = time.time()
+        rv = self.client.get('%s?wait=20' % url,
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertTrue(time.time() - start < 10)
+
+        for wait in ('3600', '-1', 'nan', 'inf', '-inf', 'foo'):
+            rv = self.client.get('%s?wait=%s' % (url, wait),
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+            self.assertEquals(rv.status_code, 400)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch.object(settings, 'STREAM_KEEPALIVE', 0.01)
+    def test_stream_idle(self):
+        """Test that idle streams don't check the database"""
+        create_test_user()
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if 'FROM build_event' in statement:
+                statements.append(statement)
+
+        rv = self.client.get('/icaas/builds/stream', buffered=False,
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        chunks = iter(rv.response)
+        engine = db.get_engine(self.app)
+        try:
+            self.assertTrue(next(chunks).startswith('retry:'))
+            self.assertEquals(next(chunks), ': keep-alive\n\n')
+            event.listen(engine, 'before_cursor_execute', count)
+            for i in range(3):
+                self.assertEquals(next(chunks), ': keep-alive\n\n')
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+            rv.close()
+        self.assertEquals(statements, [])
+
+    def test_event_cursor(self):
+        """Test that events committed out of order are not skipped"""
+        user, build = create_test_build()
+        last = db.session.query(func.max(BuildEvent.id)).scalar() or 0
+
+        def add(eventid, created=None):
+            evt = BuildEvent(build.id, user.id, 'CREATING')
+            evt.id = eventid
+            evt.created = created or evt.created
+            db.session.add(evt)
+            db.session.commit()
+
+        def ids(evts):
+            return [e.id for e in evts]
+
+        cursor = notify.EventCursor(last)
+        query = BuildEvent.query.filter(BuildEvent.build == build.id)
+        add(last + 3)
+        self.assertEquals(ids(cursor.fetch(query)), [last + 3])
+        # An event with an older ID commits later
+        add(last + 1)
+        add(last + 4)
+        self.assertEquals(ids(cursor.fetch(query)), [last + 1, last + 4])
+        self.assertEquals(cursor.fetch(query), [])
+        with patch.object(settings, 'EVENTS_PAGE_SIZE', 1):
+            add(last + 2)
+            self.assertEquals(ids(cursor.fetch(query)), [last + 2])
+            self.assertEquals(cursor.fetch(query), [])
+        with patch.object(settings, 'WATERMARK_LAG', 0):
+            self.assertEquals(cursor.fetch(query), [])
+            self.assertEquals(cursor._seen, {})
+
+        # The events endpoint holds the cursor back at the recent events
+        url = '/icaas/builds/%d/events?since=%d' % (build.id, last)
+        with patch('astakosclient.AstakosClient.authenticate',
+                   astakos_authorized):
+            rv = self.client.get(url, headers=[('X-Auth-Token', USER_TOKEN)])
+            self.assertEquals(json.loads(rv.data)['next'], last)
+            add(last + 5, datetime.utcnow() - timedelta(hours=1))
+            BuildEvent.query.filter(BuildEvent.id <= last + 3) \
+                .update({'created': datetime.utcnow() - timedelta(hours=1)})
+            db.session.commit()
+            rv = self.client.get(url, headers=[('X-Auth-Token', USER_TOKEN)])
+            data = json.loads(rv.data)
+            self.assertEquals(len(data['events']), 5)
+            self.assertEquals(data['next'], last + 3)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch.object(settings, 'STREAM_KEEPALIVE', 30)
+    def test_stream(self):
+        """Test streaming the events of the builds of a user"""
+        user, build = create_test_build()
+        rv = self.client.get('/icaas/builds/agent/%d/%s' %
+                             (build.id, build.nonce))
+        self.assertEquals(rv.status_code, 200)
+        userid, buildid, token = user.id, build.id, build.token
+
+        def report(current):
+            rv = self.client.put(
+                '/icaas/builds/agent/%d' % buildid,
+                headers=[('X-Icaas-Token', token)],
+                data=json.dumps({'status': 'CREATING',
+                                 'agent-progress': {'current': current,
+                                                    'total': 10}}),
+                content_type='application/json')
+            self.assertEquals(rv.status_code, 204)
+
+        report(1)
+        first = BuildEvent.query.order_by(BuildEvent.id).first().id
+
+        def read(chunks):
+            chunk = next(chunks)
+            fields = dict(line.split(': ', 1)
+                          for line in chunk.strip().split('\n'))
+            return int(fields['id']), json.loads(fields['data'])
+
+        rv = self.client.get('/icaas/builds/stream', buffered=False,
+                             headers=[('X-Auth-Token', USER_TOKEN),
+                                      ('Last-Event-ID', str(first))])
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(rv.mimetype, 'text/event-stream')
+        chunks = iter(rv.response)
+        try:
+            self.assertTrue(next(chunks).startswith('retry:'))
+            eventid, data = read(chunks)
+            self.assertTrue(eventid > first)
+            self.assertEquals(data['build'], buildid)
+            self.assertEquals(data['agent-progress']['current'], 1)
+
+            # New events are pushed as soon as they are committed
+            thread = threading.Thread(target=lambda: time.sleep(0.2) or
+                                      report(2))
+            thread.start()
+            start = time.time()
+            eventid, data = read(chunks)
+            thread.join()
+            self.assertTrue(time.time() - start < 10)
+            self.assertEquals(data['agent-progress']['current'], 2)
+        finally:
+            rv.close()
+        self.assertEquals(notify.subscribers(), 0)
+
+        # Events added by other processes are announced by the poller
+        changed = notify.subscribe(('user', userid))
+        try:
+            notify._poller._poll(notify.EventCursor(first))
+            self.assertTrue(changed.is_set())
+        finally:
+            notify.unsubscribe(('user', userid), changed)
+
+        rv = self.client.get('/icaas/builds/stream',
+                             headers=[('X-Auth-Token', USER_TOKEN),
+                                      ('Last-Event-ID', 'foo')])
+        self.assertEquals(rv.status_code, 400)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_etags(self):
+        """Test that unchanged builds and listings are not sent again"""
+        user, build = create_test_build()
+        auth = ('X-Auth-Token', USER_TOKEN)
+
+        for url in ('/icaas/builds/%d' % build.id, '/icaas/builds?details=1'):
+            rv = self.client.get(url, headers=[auth])
+            self.assertEquals(rv.status_code, 200)
+            etag = rv.headers['ETag']
+            self.assertTrue(etag.startswith('W/'))
+
+            rv = self.client.get(url, headers=[auth, ('If-None-Match', etag)])
+            self.assertEquals(rv.status_code, 304)
+            self.assertEquals(rv.data, '')
+            self.assertEquals(rv.headers['ETag'], etag)
+
+            time.sleep(0.01)
+            build = Build.query.get(build.id)
+            build.name = 'renamed %s' % url
+            db.session.commit()
+
+            rv = self.client.get(url, headers=[auth, ('If-None-Match', etag)])
+            self.assertEquals(rv.status_code, 200)
+            self.assertNotEquals(rv.headers['ETag'], etag)
+
+        # Listings with different parameters have different tags
+        etag = rv.headers['ETag']
+        rv = self.client.get('/icaas/builds?details=0',
+                             headers=[auth, ('If-None-Match', etag)])
+        self.assertEquals(rv.status_code, 200)
+
+        # Only the builds on the page of a listing affect its tag
+        others = []
+        for name in ('next', 'other'):
+            others.append(create_test_build(user, name=name)[1].id)
+        url = '/icaas/builds?limit=1'
+        etag = self.client.get(url, headers=[auth]).headers['ETag']
+        time.sleep(0.01)
+        Build.query.get(others[1]).name = 'renamed'
+        db.session.commit()
+        rv = self.client.get(url, headers=[auth, ('If-None-Match', etag)])
+        self.assertEquals(rv.status_code, 304)
+
+        time.sleep(0.01)
+        Build.query.get(build.id).deleted = True
+        db.session.commit()
+        rv = self.client.get(url, headers=[auth, ('If-None-Match', etag)])
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(json.loads(rv.data)['builds'][0]['id'], others[0])
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_build_events(self):
+        """Test the timeline of a build"""
+        user, build = create_test_build()
+        rv = self.client.get('/icaas/builds/agent/%d/%s' %
+                             (build.id, build.nonce))
+        self.assertEquals(rv.status_code, 200)
+        for current in (1, 1, 2):
+            rv = self.client.put(
+                '/icaas/builds/agent/%d' % build.id,
+                headers=[('X-Icaas-Token', build.token)],
+                data=json.dumps({'status': 'CREATING',
+                                 'agent-progress': {'current': current,
+                                                    'total': 10}}),
+                content_type='application/json')
+            self.assertEquals(rv.status_code, 204)
+
+        url = '/icaas/builds/%d/events' % build.id
+        rv = self.client.get(url, headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 200)
+        events = json.loads(rv.data)['events']
+        self.assertEquals(len(events), 3)
+        self.assertEquals(events[0]['details'], 'Agent booted normally')
+        self.assertEquals([e['agent-progress']['current']
+                           for e in events[1:]], [1, 2])
+
+        rv = self.client.get('%s?since=%d' % (url, events[1]['id']),
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(json.loads(rv.data)['events'], events[2:])
+
+        rv = self.client.get('%s?since=foo' % url,
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 400)
+        rv = self.client.get('/icaas/builds/%d/events' % (build.id + 1),
+                             headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 404)
+
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    def test_expire_stalled(self):
+        """Test that builds whose agent stopped reporting back are reaped"""
+        user, build = create_test_build()
+        build.agent_alive = True
+
+        # The agent reports back after retrieving the manifest
+        rv = self.client.get('/icaas/builds/agent/%d/%s' %
+                             (build.id, build.nonce))
+        self.assertEquals(rv.status_code, 200)
+        first = BuildProgress.query.get(build.id).last_heartbeat
+        rv = self.client.put('/icaas/builds/agent/%d' % build.id,
+                             headers=[('X-Icaas-Token', build.token)],
+                             data=json.dumps({'status': 'CREATING'}),
+                             content_type='application/json')
+        self.assertEquals(rv.status_code, 204)
+        self.assertTrue(BuildProgress.query.get(build.id).last_heartbeat >=
+                        first)
+
+        pool = WorkerPool('TestReaper', 1, 2)
+        try:
+            self.assertEquals(expire_stalled(2, pool), 0)
+            BuildProgress.query.get(build.id).last_heartbeat = \
+                datetime.utcnow() - timedelta(hours=1)
+            db.session.commit()
+            with patch.object(settings, 'METRICS_TOKEN', 'secret'):
+                rv = self.client.get('/icaas/metrics',
+                                     headers=[('X-Metrics-Token', 'secret')])
+            lag = json.loads(rv.data)['metrics']['heartbeat_lag']
+            self.assertEquals(lag['builds'], 1)
+            self.assertEquals(lag['stalled'], 1)
+            self.assertTrue(lag['max'] >= 3600)
+
+            self.assertEquals(expire_stalled(2, pool), 1)
+            self.assertEquals(expire_stalled(2, pool), 0)
+        finally:
+            pool.shutdown()
+
+        build = Build.query.get(build.id)
+        self.assertEquals(build.status, 'ERROR')
+        self.assertFalse(build.agent_alive)
+
+    def test_upgradedb(self):
+        """Test upgrading the database of an older deployment"""
+        db.drop_all()
+
+        new = ('manifest_deadline', 'agent_deadline')
+        meta = MetaData()
+        User.__table__.tometadata(meta)
+        Table('build', meta, *[c.copy() for c in Build.__table__.columns
+                               if c.name not in new])
+        meta.create_all(db.engine)
+
+        user = create_test_user()
+        db.engine.execute(meta.tables['build'].insert(),
+                          user=user.id, name='old', status='CREATING',
+                          created=datetime.utcnow(), deleted=False,
+                          nonce='nonce')
+
+        upgrade()
+
+        inspector = inspect(db.engine)
+        columns = [c['name'] for c in inspector.get_columns('build')]
+        self.assertTrue(set(new).issubset(columns))
+        indexes = [i['name'] for i in inspector.get_indexes('build')]
+        self.assertIn('build_agent_deadline_index', indexes)
+
+        build = Build.query.filter_by(name='old').one()
+        self.assertEquals(build.agent_deadline - build.created,
+                          timedelta(minutes=settings.AGENT_TIMEOUT))
+
+        # Upgrading an up to date database should do nothing
+        upgrade()
+
+    def test_metrics(self):
+        """Test the metrics endpoint"""
+        rv = self.client.get('/icaas/metrics')
+        self.assertEquals(rv.status_code, 404)
+
+        with patch.object(settings, 'METRICS_TOKEN', 'secret'):
+            rv = self.client.get('/icaas/metrics',
+                                 headers=[('X-Metrics-Token', 'wrong')])
+            self.assertEquals(rv.status_code, 401)
+
+            rv = self.client.get('/icaas/metrics',
+                                 headers=[('X-Metrics-Token', 'secret')])
+            self.assertEquals(rv.status_code, 200)
+            metrics = json.loads(rv.data)['metrics']
+            self.assertIn('CreateAgent', metrics['pools'])
+            self.assertIn('DestroyAgent', metrics['pools'])
+            self.assertIn('hits', metrics['token_cache'])
+
     @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
     @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
            kamaki_delete_server)
@@ -199,10 +1605,8 @@ class IcaasTestCase(TestCase):
 
         self.assertEquals(rv.status_code, 204)
 
-        # Wait for the agent destruction thread to finish
-        for t in threading.enumerate():
-            if t.name.startswith('DestroyAgentThread'):
-                t.join()
+        # Wait for the agent destruction task to finish
+        destroy_pool.join()
 
         rv = self.client.get('/icaas/builds/%d' % build.id,
                              headers=[('X-AUTH-Token', USER_TOKEN)])
@@ -238,10 +1642,107 @@ class IcaasTestCase(TestCase):
 
         self.assertEquals(rv.status_code, 204)
 
-        # Wait for the agent destruction thread to finish
-        for t in threading.enumerate():
-            if t.name.startswith('DestroyAgentThread'):
-                t.join()
+        # Wait for the agent destruction task to finish
+        destroy_pool.join()
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
+           kamaki_delete_server)
+    @patch.object(settings, 'DISPATCH_IN_PROCESS', False)
+    def test_bulk_cancel_delete(self):
+        """Test canceling and deleting many builds at once"""
+        user, build = create_test_build()
+        builds = [build]
+        for name in ('bad_1', 'bad_2', 'good'):
+            builds.append(create_test_build(user, name=name,
+                                            agent=str(len(builds)),
+                                            agent_alive=True)[1])
+        builds[2].status = 'COMPLETED'
+        builds[1].callback = 'http://example.org/callback'
+        db.session.commit()
+        ids = [b.id for b in builds]
+
+        def put(data):
+            rv = self.client.put('/icaas/builds', data=json.dumps(data),
+                                 headers=[('X-Auth-Token', USER_TOKEN)],
+                                 content_type='application/json')
+            return rv.status_code, json.loads(rv.data)
+
+        code, data = put({'action': 'cancel',
+                          'ids': [ids[1], 42, ids[2], ids[1]]})
+        self.assertEquals(code, 200)
+        self.assertEquals([(r['id'], r['status']) for r in data['builds']],
+                          [(ids[1], 204), (42, 404), (ids[2], 403)])
+
+        canceled = Build.query.get(ids[1])
+        self.assertEquals(canceled.status, 'CANCELED')
+        self.assertEquals(json.loads(canceled.status_details)['details'],
+                          "Canceled by the user")
+        self.assertEquals(Build.query.get(ids[2]).status, 'COMPLETED')
+        self.assertEquals(sorted(j.action for j in
+                                 Job.query.filter_by(build=ids[1])),
+                          ['DESTROY', 'NOTIFY'])
+        self.assertEquals(BuildEvent.query.filter_by(
+            build=ids[1], status='CANCELED').count(), 1)
+
+        # Only the active builds are canceled by a filter
+        code, data = put({'action': 'cancel',
+                          'filter': {'name_prefix': 'bad_'}})
+        self.assertEquals(data['builds'], [])
+
+        code, data = put({'action': 'delete',
+                          'filter': {'name_prefix': 'bad_'}})
+        # The callback is left alone, it would be sent to example.org
+        for job in Job.query.filter_by(action='DESTROY').all():
+            self.assertTrue(jobs.run_job(job.id))
+        self.assertEquals(code, 200)
+        self.assertEquals([r['id'] for r in data['builds']], ids[1:3])
+        self.assertEquals([b.id for b in Build.query.filter_by(
+            deleted=False).order_by(Build.id)], [ids[0], ids[3]])
+        self.assertFalse(Build.query.get(ids[2]).agent_alive)
+
+        for data in ({'action': 'cancel'}, {'action': 'stop', 'ids': [1]},
+                     {'action': 'delete', 'ids': [1], 'filter': {}},
+                     {'action': 'delete', 'ids': ['1']},
+                     {'action': 'delete', 'filter': {'status': 'DONE'}},
+                     {'action': 'delete', 'filter': {'name': 'x'}}):
+            self.assertEquals(put(data)[0], 400)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    @patch('kamaki.clients.cyclades.CycladesComputeClient.create_server',
+           kamaki_create_server)
+    def test_build_timeout(self):
+        """Test setting and extending the time the agent has to finish"""
+        rv = self.client.post('/icaas/builds',
+                              headers=[('X-Auth-Token', USER_TOKEN)],
+                              data=build_request(timeout=90),
+                              content_type='application/json')
+        self.assertEquals(rv.status_code, 202)
+        create_pool.join()
+
+        buildid = json.loads(rv.data)['build']['id']
+        build = Build.query.get(buildid)
+        self.assertEquals(build.agent_deadline - build.created,
+                          timedelta(minutes=90))
+        self.assertEquals(build.manifest_deadline - build.created,
+                          timedelta(minutes=settings.MANIFEST_TIMEOUT))
+
+        rv = self.client.put('/icaas/builds/%d' % buildid,
+                             headers=[('X-AUTH-Token', USER_TOKEN)],
+                             data=json.dumps({'action': 'extend',
+                                              'minutes': 30}),
+                             content_type='application/json')
+        self.assertEquals(rv.status_code, 204)
+        build = Build.query.get(buildid)
+        self.assertEquals(build.agent_deadline - build.created,
+                          timedelta(minutes=120))
+
+        rv = self.client.put('/icaas/builds/%d' % buildid,
+                             headers=[('X-AUTH-Token', USER_TOKEN)],
+                             data=json.dumps({'action': 'extend',
+                                              'minutes': 200}),
+                             content_type='application/json')
+        self.assertEquals(rv.status_code, 400)
 
     @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
     def test_invalid_update_action(self):
@@ -294,5 +1795,27 @@ class IcaasTestCase(TestCase):
                              (build.id, build.nonce))
         self.assertEquals(rv.status_code, 403)
 
+    def test_agent_manifest_no_deadline(self):
+        """Test fetching the manifest of a build without deadlines"""
+        user, build = create_test_build()
+        build.manifest_deadline = None
+        build.agent_deadline = None
+        db.session.commit()
+
+        rv = self.client.get('/icaas/builds/agent/%d/%s' %
+                             (build.id, build.nonce))
+        self.assertEquals(rv.status_code, 200)
+
+        _, build = create_test_build(
+            user, name="Old Image", agent=None, manifest_deadline=None,
+            created=datetime.utcnow() -
+            timedelta(minutes=int(settings.MANIFEST_TIMEOUT) + 1))
+
+        with patch.object(settings, 'DISPATCH_IN_PROCESS', False):
+            rv = self.client.get('/icaas/builds/agent/%d/%s' %
+                                 (build.id, build.nonce))
+        self.assertEquals(rv.status_code, 403)
+        self.assertEquals(Build.query.get(build.id).status, 'ERROR')
+
 
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
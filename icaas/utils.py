@@ -19,16 +19,228 @@
 """Various handy functions to be used by the ICaaS modules"""
 
 from datetime import datetime, timedelta
+from base64 import b64encode
+import ConfigParser
+import StringIO
+import binascii
 import logging
+import socket
+import json
 
 from kamaki.clients import cyclades, ClientError
 
-from icaas.models import Build, User, db
+from icaas.models import Build, BuildEvent, BuildProgress, User, db
+from icaas.error import Error
 from icaas import settings
 
+AGENT_CONFIG = "/etc/icaas/manifest.cfg"
+AGENT_INIT = "/.icaas"
+
 logger = logging.getLogger(__name__)
 
 
+# The networks the callbacks are not sent to unless their host is allowed:
+# unspecified, loopback, private, shared, link-local, multicast and reserved
+PRIVATE_NETWORKS = [
+    (socket.AF_INET, '0.0.0.0', 8), (socket.AF_INET, '10.0.0.0', 8),
+    (socket.AF_INET, '100.64.0.0', 10), (socket.AF_INET, '127.0.0.0', 8),
+    (socket.AF_INET, '169.254.0.0', 16), (socket.AF_INET, '172.16.0.0', 12),
+    (socket.AF_INET, '192.168.0.0', 16), (socket.AF_INET, '224.0.0.0', 3),
+    (socket.AF_INET6, '::', 127), (socket.AF_INET6, 'fc00::', 7),
+    (socket.AF_INET6, 'fe80::', 10), (socket.AF_INET6, 'ff00::', 8)]
+
+# IPv4 addresses mapped to IPv6 are checked as IPv4 ones
+_IPV4_MAPPED = binascii.unhexlify('00000000000000000000ffff')
+
+
+def _to_int(packed):
+    return int(binascii.hexlify(packed), 16)
+
+
+def is_private_address(address):
+    """Check if an IPv4 or IPv6 address is not publicly routable"""
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    packed = socket.inet_pton(family, address.split('%')[0])
+    if family == socket.AF_INET6 and packed.startswith(_IPV4_MAPPED):
+        family, packed = socket.AF_INET, packed[len(_IPV4_MAPPED):]
+
+    bits = len(packed) * 8
+    for net_family, network, prefix in PRIVATE_NETWORKS:
+        if net_family != family:
+            continue
+        net = _to_int(socket.inet_pton(family, network))
+        if _to_int(packed) >> (bits - prefix) == net >> (bits - prefix):
+            return True
+    return False
+
+
+def check_callback_host(host):
+    """Check that the host of a callback URL is allowed or only resolves to
+    public addresses. Raises socket.error if the host cannot be resolved and
+    ValueError if it is not allowed.
+    """
+    allowed = settings.CALLBACK_ALLOWED_HOSTS
+    if isinstance(allowed, basestring):
+        allowed = allowed.split(',')
+    if host in allowed:
+        return
+    for _, _, _, _, sockaddr in socket.getaddrinfo(host, None):
+        if is_private_address(sockaddr[0]):
+            raise ValueError("Callbacks to %s are not allowed" % host)
+
+
+# Maximum number of values bound to a single INSERT statement. SQLite does
+# not accept more than 999.
+INSERT_MAX_VALUES = 900
+
+
+def insert_all(objects):
+    """Insert many new objects of the same model with multi-row INSERT
+    statements. The objects are not added to the session and their IDs are
+    not retrieved, but the defaults of their columns are filled in. The
+    statements are committed with the current session.
+    """
+    if not objects:
+        return
+
+    table = objects[0].__table__
+    columns = [c for c in table.columns if not c.primary_key]
+    rows = []
+    for obj in objects:
+        row = {}
+        for column in columns:
+            value = getattr(obj, column.key)
+            if value is None and column.default is not None:
+                # Fill in the defaults the way the ORM would
+                value = column.default.arg
+                if column.default.is_callable:
+                    value = value(None)
+                setattr(obj, column.key, value)
+            row[column.key] = value
+        rows.append(row)
+
+    chunk = max(INSERT_MAX_VALUES // len(columns), 1)
+    for i in range(0, len(rows), chunk):
+        db.session.execute(table.insert().values(rows[i:i + chunk]))
+
+
+def parse_progress(params):
+    """Return the progress reported by an agent or None if there is none.
+    Raises Error if the progress is malformed.
+    """
+    agent_progress = params.get("agent-progress", None)
+    if not agent_progress:
+        return None
+    try:
+        return {'current': int(agent_progress['current']),
+                'total': int(agent_progress['total'])}
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("Failed to parse 'agent-progress' with error '%s'",
+                       str(e))
+        raise Error("Malformed status details", status=400)
+
+
+def add_event(build, details=None, progress=None):
+    """Append an event to the timeline of a build. The build needs to have
+    been flushed to the database.
+    """
+    db.session.add(BuildEvent(build.id, build.user, build.status, details,
+                              progress))
+
+
+def update_status_details(build, params):
+    """Update the status details of a build and record the change in its
+    timeline
+    """
+    details = build.status_details
+    details = json.loads(details) if details else {}
+    curtask = params.get('details', None)
+    if curtask:
+        details['details'] = curtask
+    agent_progress = parse_progress(params)
+    if agent_progress:
+        details['agent-progress'] = agent_progress
+    else:
+        # Keep the progress that has not been written to the build yet
+        with db.session.no_autoflush:
+            row = BuildProgress.query.get(build.id)
+        if row is not None and row.current is not None:
+            details['agent-progress'] = row.to_dict()
+
+    build.status_details = json.dumps(details)
+    add_event(build, curtask, agent_progress)
+
+
+def record_progress(build, params, flush=False):
+    """Record a report of the agent of a build. The reported progress is kept
+    in the narrow progress table. It is written to the status details of the
+    build only if `flush` is True or if more than PROGRESS_FLUSH_INTERVAL
+    seconds have passed since it was last written there. The changes are
+    committed with the current session.
+    """
+    progress = parse_progress(params)
+    now = datetime.utcnow()
+
+    # Changes on the build are written along with the status details
+    with db.session.no_autoflush:
+        row = BuildProgress.query.get(build.id)
+    if row is None:
+        row = BuildProgress(build.id)
+        db.session.add(row)
+    row.last_heartbeat = now
+    moved = False
+    if progress:
+        moved = (row.current, row.total) != (progress['current'],
+                                             progress['total'])
+        row.current = progress['current']
+        row.total = progress['total']
+
+    if flush or row.flushed is None or \
+            (now - row.flushed).total_seconds() >= \
+            int(settings.PROGRESS_FLUSH_INTERVAL):
+        update_status_details(build, params)
+        row.flushed = now
+    elif moved:
+        # Reports that don't change anything are left out of the timeline
+        add_event(build, progress=progress)
+
+
+def find_agent(token, name):
+    """Return the agent VM with the specified name or None if there is none"""
+    compute = cyclades.CycladesComputeClient(settings.COMPUTE_URL, token)
+    for server in compute.list_servers(name=name):
+        if server['name'] == name:
+            return server
+    return None
+
+
+def create_agent(build, token, name, project=None, networks=None):
+    """Create the agent VM of a build and return the server info"""
+    logger.info('create_agent of build %d' % build.id)
+
+    # Create the manifest URL
+    config = ConfigParser.ConfigParser()
+    config.add_section("manifest")
+    config.set("manifest", "url", "%s/builds/agent/%d/%s" %
+               (settings.ENDPOINT, build.id, build.nonce))
+    manifest = StringIO.StringIO()
+    config.write(manifest)
+
+    personality = [
+        {'contents': b64encode(manifest.getvalue()), 'path': AGENT_CONFIG,
+         'owner': 'root', 'group': 'root', 'mode': 0600},
+        {'contents': b64encode("empty"), 'path': AGENT_INIT,
+         'owner': 'root', 'group': 'root', 'mode': 0600}]
+
+    compute = cyclades.CycladesComputeClient(settings.COMPUTE_URL, token)
+    return compute.create_server(name,
+                                 settings.AGENT_IMAGE_FLAVOR_ID,
+                                 settings.AGENT_IMAGE_ID,
+                                 project_id=project,
+                                 networks=networks,
+                                 personality=personality)
+
+
 def destroy_agent(build):
     """Destroy the agent associated with a build"""
     logger.info('destroy_agent of build %d' % build.id)
@@ -45,7 +257,7 @@ def destroy_agent(build):
     except ClientError as e:
         logger.error('failed to delete the icaas agent of build %d: (%d, %s)'
                      % (build.id, e.status, e))
-        if e.status == 400:  # The server is probably dead already
+        if e.status in (400, 404):  # The server is probably dead already
             build.agent_alive = False
             db.session.commit()
             return True
@@ -61,17 +273,32 @@ def destroy_agent(build):
     return True
 
 
-def exec_on_timeout(timeout, action):
-    """Perform an action on all the builds that have timed out"""
+def exec_on_timeout(timeout, action, chunk=100):
+    """Perform an action on all the builds that have timed out. If timeout is
+    None, the agent deadline of each build is used.
+    """
+
+    now = datetime.utcnow()
+    if timeout is None:
+        expired = Build.agent_deadline < now
+    else:
+        expired = Build.created < now - timedelta(minutes=timeout)
 
-    expiration = datetime.utcnow() - timedelta(minutes=timeout)
+    # Page through the builds to avoid loading all of them at once
+    last = 0
+    while True:
+        builds = Build.query.filter(expired,
+                                    Build.agent_alive == True,  # noqa
+                                    Build.id > last) \
+            .order_by(Build.id).limit(chunk).all()
+        if not builds:
+            break
 
-    builds = Build.query.filter(Build.created < expiration,
-                                Build.agent_alive == True).all()  # noqa
+        # Perform the action on all builds that have expired
+        for b in builds:
+            logger.info("Build %d timed out" % b.id)
+            action(b)
 
-    # Perform the action on all builds that have expired
-    for b in builds:
-        logger.info("Build %d timed out" % b.id)
-        action(b)
+        last = builds[-1].id
 
 # vim: ai ts=4 sts=4 et sw=4 ft=python
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Module implementing the pools of threads that run the background tasks"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+import Queue
+
+from flask import current_app
+
+from icaas import settings
+
+logger = logging.getLogger(__name__)
+
+# All the worker pools created by this process
+pools = []
+
+
+class PoolFull(Exception):
+    """Raised when the queue of a worker pool is full"""
+
+
+class WorkerPool(object):
+    """A fixed number of threads executing tasks from a bounded queue"""
+
+    def __init__(self, name, size, queue_size):
+        """Initialize a WorkerPool instance"""
+        self.name = name
+        self.size = int(size)
+        self.queue_size = int(queue_size)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.active = 0
+        self._queue = Queue.Queue(maxsize=self.queue_size)
+        self._threads = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        pools.append(self)
+
+    def _start(self):
+        """Start the threads of the pool. This is done lazily to play well
+        with servers that fork after importing the application.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # The threads of the parent process don't exist after a fork
+                self._pid = os.getpid()
+                self._threads = []
+                self._queue = Queue.Queue(maxsize=self.queue_size)
+            if self._threads:
+                return
+            for i in range(self.size):
+                thread = threading.Thread(target=self._work,
+                                          name="%sWorker-%d" % (self.name, i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        """The main loop of a pool thread"""
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                return
+
+            app, func, args, kwargs = task
+            with self._lock:
+                self.active += 1
+            try:
+                with app.app_context():
+                    func(*args, **kwargs)
+            except Exception:
+                logger.exception("%s task %s failed" %
+                                 (self.name, func.__name__))
+                with self._lock:
+                    self.failed += 1
+            else:
+                with self._lock:
+                    self.completed += 1
+            finally:
+                with self._lock:
+                    self.active -= 1
+                self._queue.task_done()
+
+    def full(self):
+        """Returns True if the pool cannot accept any more tasks"""
+        return self._queue.full()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a task for execution. The task will run in the context of the
+        current application. Raises PoolFull if the queue is full.
+        """
+        self._start()
+        app = current_app._get_current_object()
+        try:
+            self._queue.put_nowait((app, func, args, kwargs))
+        except Queue.Full:
+            with self._lock:
+                self.rejected += 1
+            logger.warning("%s queue is full, rejecting task %s" %
+                           (self.name, func.__name__))
+            raise PoolFull(self.name)
+
+        with self._lock:
+            self.submitted += 1
+
+    def join(self):
+        """Wait until all the queued tasks have been processed"""
+        self._queue.join()
+
+    def shutdown(self, timeout=None):
+        """Process the queued tasks and stop the threads of the pool"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+
+        if not threads:
+            return
+
+        deadline = None if timeout is None else time.time() + timeout
+        for _ in threads:
+            try:
+                self._queue.put(None, timeout=None if deadline is None
+                                else max(deadline - time.time(), 0))
+            except Queue.Full:
+                logger.warning("%s pool did not drain in time" % self.name)
+                return
+        for thread in threads:
+            thread.join(None if deadline is None
+                        else max(deadline - time.time(), 0))
+            if thread.is_alive():
+                logger.warning("%s pool did not drain in time" % self.name)
+                break
+
+    def stats(self):
+        """Return the pool counters"""
+        with self._lock:
+            return {'size': self.size,
+                    'queue_size': self.queue_size,
+                    'queued': self._queue.qsize(),
+                    'active': self.active,
+                    'submitted': self.submitted,
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'rejected': self.rejected}
+
+
+# Pool that creates the ICaaS agent VMs
+create_pool = WorkerPool('CreateAgent', settings.CREATE_WORKERS,
+                         settings.CREATE_QUEUE_SIZE)
+
+# Pool that destroys the ICaaS agent VMs
+destroy_pool = WorkerPool('DestroyAgent', settings.DESTROY_WORKERS,
+                          settings.DESTROY_QUEUE_SIZE)
+
+# Pool that delivers the build completion callbacks
+webhook_pool = WorkerPool('Webhook', settings.WEBHOOK_WORKERS,
+                          settings.WEBHOOK_QUEUE_SIZE)
+
+
+@atexit.register
+def shutdown():
+    """Drain all the worker pools"""
+    for pool in pools:
+        pool.shutdown(float(settings.WORKER_SHUTDOWN_TIMEOUT))
+
+# vim: ai ts=4 sts=4 et sw=4 ft=python
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Show the plans and the latencies of the queries ICaaS runs the most.
+
+The database is filled with fake builds until it hosts the requested number
+of them. Never point this to the database of a real deployment.
+
+Example:
+
+    $ createdb icaas_benchmark
+    $ ./tools/benchmark_db.py -n 1000000 postgres://localhost/icaas_benchmark
+"""
+
+from datetime import datetime, timedelta
+from uuid import uuid4
+import argparse
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from sqlalchemy import and_, func  # noqa
+
+from icaas import create_app  # noqa
+from icaas.models import Build, BuildProgress, Job, User, db  # noqa
+from icaas.schema import upgrade  # noqa
+
+# Number of rows inserted at once
+BATCH = 10000
+
+
+def populate(builds, users):
+    """Add fake builds until the database hosts `builds` of them"""
+    for i in range(db.session.query(func.count(User.id)).scalar(), users):
+        db.session.add(User('benchmark-%d' % i))
+    db.session.commit()
+    userids = [row[0] for row in db.session.query(User.id)]
+
+    count = db.session.query(func.count(Build.id)).scalar()
+    db.session.commit()
+    now = datetime.utcnow()
+    while count < builds:
+        rows = []
+        for i in range(min(BATCH, builds - count)):
+            created = now - timedelta(minutes=random.randint(0, 525600))
+            # About 0.1% of the builds are still running
+            active = random.random() < 0.001
+            status = 'CREATING' if active else \
+                random.choice(('COMPLETED', 'COMPLETED', 'ERROR', 'CANCELED'))
+            rows.append({'user': random.choice(userids),
+                         'name': 'image-%d' % (count + i),
+                         'description': '',
+                         'public': False,
+                         'status': status,
+                         'agent': str(count + i),
+                         'agent_alive': active,
+                         'src': 'http://example.org/image.zip',
+                         'image': '{"container": "images", "object": "i"}',
+                         'log': '{"container": "log", "object": "log"}',
+                         'created': created,
+                         'updated': created,
+                         'deleted': random.random() < 0.1,
+                         'status_details': '{"details": "benchmark"}',
+                         'token': uuid4().hex,
+                         'nonce': uuid4().hex + uuid4().hex,
+                         'nonce_invalid': not active or random.random() < .9,
+                         'manifest_deadline': created + timedelta(minutes=5),
+                         'agent_deadline': created + timedelta(hours=1)})
+        db.engine.execute(Build.__table__.insert(), rows)
+        count += len(rows)
+        sys.stderr.write('%d builds\r' % count)
+    sys.stderr.write('\n')
+
+    if db.engine.dialect.name == 'postgresql':
+        db.engine.execution_options(isolation_level='AUTOCOMMIT') \
+            .execute('VACUUM ANALYZE')
+    else:
+        db.engine.execute('ANALYZE')
+
+
+def queries():
+    """Return the queries to benchmark"""
+    build = Build.query.order_by(func.random()).first()
+    user, now = build.user, datetime.utcnow()
+    db.session.commit()
+
+    return [
+        ('list builds', Build.query.filter(
+            Build.user == user, Build.deleted == False)  # noqa
+            .order_by(Build.created, Build.id).limit(100)),
+        ('list builds by status', Build.query.filter(
+            Build.user == user, Build.deleted == False,  # noqa
+            Build.status == 'ERROR')
+            .order_by(Build.created, Build.id).limit(100)),
+        ('view build', Build.query.filter_by(id=build.id, user=user,
+                                             deleted=False)),
+        ('agent update', Build.query.filter_by(id=build.id, token=build.token,
+                                               deleted=False)),
+        ('agent manifest', Build.query.filter_by(id=build.id,
+                                                 nonce=build.nonce,
+                                                 deleted=False)),
+        ('timed out agents', Build.query.filter(
+            Build.agent_alive == True,  # noqa
+            Build.agent_deadline < now).order_by(Build.id).limit(100)),
+        ('expired manifests', Build.query.filter(
+            Build.status == 'CREATING',
+            Build.nonce_invalid == False,  # noqa
+            Build.manifest_deadline < now).order_by(Build.id).limit(100)),
+        ('stalled agents', Build.query.filter(
+            Build.status == 'CREATING',
+            Build.nonce_invalid == True,  # noqa
+            BuildProgress.build == Build.id,
+            BuildProgress.last_heartbeat < now).order_by(Build.id)
+            .limit(100)),
+        ('due jobs', Job.query.filter(
+            and_(Job.state == 'PENDING', Job.next_attempt <= now))
+            .order_by(Job.next_attempt).limit(100)),
+    ]
+
+
+def explain(query):
+    """Return the plan of a query"""
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    if db.engine.dialect.name == 'postgresql':
+        prefix = 'EXPLAIN '
+    else:
+        prefix = 'EXPLAIN QUERY PLAN '
+
+    if compiled.positional:
+        params = tuple(compiled.params[k] for k in compiled.positiontup)
+    else:
+        params = compiled.params
+    rows = db.engine.execute(prefix + compiled.string, params)
+    return '\n'.join('    ' + ' '.join(str(c) for c in row) for row in rows)
+
+
+def measure(query, repeat):
+    """Return the best and the average latency of a query in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        query.all()
+        timings.append((time.time() - start) * 1000)
+        db.session.commit()
+    return min(timings), sum(timings) / len(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ICaaS database queries")
+    parser.add_argument('uri', metavar='DATABASE_URI',
+                        help='database to benchmark')
+    parser.add_argument('-n', '--builds', type=int, default=1000000,
+                        help='number of builds [%(default)s]')
+    parser.add_argument('-u', '--users', type=int, default=10000,
+                        help='number of users [%(default)s]')
+    parser.add_argument('-r', '--repeat', type=int, default=20,
+                        help='times to run each query [%(default)s]')
+    args = parser.parse_args()
+
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.uri
+    with app.app_context():
+        upgrade()
+        populate(args.builds, args.users)
+
+        for name, query in queries():
+            best, avg = measure(query, args.repeat)
+            print "%s: best %.2f ms, average %.2f ms" % (name, best, avg)
+            print explain(query)
+
+if __name__ == '__main__':
+    main()
+
+# vim: ai ts=4 sts=4 et sw=4 ft=python